@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+from dnsClient import QUERY_TYPES, Resolver, ResolverCache, resolve_one
+
+
+# Metrics compared against a baseline, and whether a larger value is better
+COMPARED_METRICS = {'qps': True, 'latency_ms.p50': False, 'latency_ms.p95': False, 'latency_ms.p99': False,
+                    'cpu_per_query_us': False, 'retries': False}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-s', '--server', type=str, default='127.0.0.1')  # IPv4 address of the DNS server
+    parser.add_argument('-p', '--port', type=int, default=5353)  # port of the DNS server
+
+    # Start mockDnsServer.py on the server address and port for the run, misbehaving as asked
+    parser.add_argument('--spawn', action='store_true')
+    parser.add_argument('--delay', type=float, default=0.0)  # seconds the mock server waits before answering
+    parser.add_argument('--jitter', type=float, default=0.0)  # up to this many seconds more, at random
+    parser.add_argument('--loss', type=float, default=0.0)  # fraction of queries the mock server drops
+    parser.add_argument('--truncate', type=float, default=0.0)  # fraction of responses the mock server truncates
+    parser.add_argument('--zone', type=str, action='append', default=[])  # zone files for the mock server
+
+    # Load
+    parser.add_argument('-n', '--queries', type=int, default=10000)  # number of queries to send
+    parser.add_argument('--rate', type=float, default=0)  # queries started per second, 0 to keep concurrency
+    # queries in flight at all times
+    parser.add_argument('-c', '--concurrency', type=int, default=100)  # maximum number of queries in flight
+    parser.add_argument('--names', type=str, default=None)  # file of names to ask for, in turn (one per line);
+    # generated names under the mock server's bench.test zone by default
+    parser.add_argument('--distinct', type=int, default=0)  # number of distinct generated names, 0 for all distinct
+    parser.add_argument('--type', type=str, default='A', choices=sorted(QUERY_TYPES))
+
+    # Client settings, as in dnsClient.py
+    parser.add_argument('-t', '--timeout', type=float, default=1.0)
+    parser.add_argument('-r', '--max_retries', type=int, default=3)
+    parser.add_argument('--payload-size', type=int, default=1232)
+    parser.add_argument('--tcp-connections', type=int, default=4)
+    parser.add_argument('--hedge-percentile', type=float, default=95)
+    parser.add_argument('--cache-size', type=int, default=0)  # answers cached by the client, 0 for none
+
+    # Report
+    parser.add_argument('-o', '--output', type=str, default=None)  # file the JSON report is written to
+    parser.add_argument('--baseline', type=str, default=None)  # JSON report of an earlier run to compare with
+    parser.add_argument('--max-regression', type=float, default=None)  # with --baseline, exit with status 1 if a
+    # compared metric got worse by more than this percentage
+
+    return parser.parse_args()
+
+
+def validate_args(args):
+    error = ""
+    is_error = False
+
+    if args.queries < 1 or args.concurrency < 1:
+        is_error = True
+        error += f"ERROR    Queries and concurrency must be at least 1\n"
+
+    if args.rate < 0 or args.distinct < 0:
+        is_error = True
+        error += f"ERROR    Rate and distinct names must be non-negative\n"
+
+    if args.timeout <= 0 or args.max_retries < 0:
+        is_error = True
+        error += f"ERROR    Timeout must be positive and max-retries non-negative\n"
+
+    if args.max_regression is not None and args.baseline is None:
+        is_error = True
+        error += f"ERROR    Max-regression needs a baseline\n"
+
+    if is_error:
+        print(error)
+        sys.exit(1)
+
+
+# Names to ask for, args.queries of them
+def query_names(args):
+    if args.names is not None:
+        with open(args.names) as file:
+            names = [line.split()[0] for line in file if line.strip() and not line.startswith('#')]
+        return [names[index % len(names)] for index in range(args.queries)]
+
+    distinct = args.distinct or args.queries
+    return [f"host{index % distinct}.bench.test" for index in range(args.queries)]
+
+
+# Start mockDnsServer.py for the run and wait until it listens; it runs in its own process, so its work isn't
+# counted in the client's CPU time
+def spawn_server(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mockDnsServer.py'),
+               '-a', args.server, '-p', str(args.port), '--delay', str(args.delay), '--jitter', str(args.jitter),
+               '--loss', str(args.loss), '--truncate', str(args.truncate), '--seed', '0']
+    for zone in args.zone:
+        command += ['-z', zone]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    if not process.stdout.readline():  # the ready line
+        print(f"ERROR    Mock DNS server failed to start")
+        sys.exit(1)
+    return process
+
+
+# Send a query for every name through the client's Resolver, as bulk mode does, and measure it
+# With a rate, queries are started on a fixed schedule whatever the server's speed (open loop), and a query's
+# latency counts from its scheduled start, so time spent waiting for a free slot behind slow queries is included
+async def run_load(args, names):
+    resolver = Resolver([args.server], args.port, args.timeout, args.max_retries, args.payload_size,
+                        args.tcp_connections, args.hedge_percentile, cache=ResolverCache(args.cache_size))
+    slots = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    statuses = collections.Counter()
+    retries = collections.Counter()  # number of retries -> queries that needed that many
+    tasks = set()
+
+    async def run(name, scheduled, holding_slot):
+        try:
+            if not holding_slot:
+                await slots.acquire()
+            result = await resolve_one(resolver, name, args.type)
+        finally:
+            slots.release()
+        latencies.append(time.perf_counter() - scheduled)
+        statuses[result['status']] += 1
+        retries[result.get('retries', 0)] += 1
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        for index, name in enumerate(names):
+            if args.rate:
+                scheduled = start + index / args.rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0.001:  # shorter waits are left to catch up with the next query
+                    await asyncio.sleep(delay)
+            else:
+                await slots.acquire()
+                scheduled = time.perf_counter()
+
+            task = asyncio.create_task(run(name, scheduled, not args.rate))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        hedged = resolver.hedged
+        await resolver.aclose()
+
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    return report(args, latencies, statuses, retries, hedged, seconds, cpu_seconds)
+
+
+# Value below which percentage of the sorted values lie (nearest rank)
+def percentile(ordered, percentage):
+    return ordered[min(int(len(ordered) * percentage / 100), len(ordered) - 1)]
+
+
+def report(args, latencies, statuses, retries, hedged, seconds, cpu_seconds):
+    ordered = sorted(latencies)
+    milliseconds = [latency * 1000 for latency in ordered]
+    return {
+        'config': {'server': args.server, 'port': args.port, 'queries': args.queries, 'rate': args.rate,
+                   'concurrency': args.concurrency, 'distinct': args.distinct, 'type': args.type,
+                   'timeout': args.timeout, 'max_retries': args.max_retries, 'payload_size': args.payload_size,
+                   'cache_size': args.cache_size, 'spawned': args.spawn, 'delay': args.delay, 'jitter': args.jitter,
+                   'loss': args.loss, 'truncate': args.truncate},
+        'queries': len(latencies),
+        'seconds': round(seconds, 6),
+        'qps': round(len(latencies) / seconds, 1),
+        'latency_ms': {'mean': round(sum(milliseconds) / len(milliseconds), 3),
+                       'p50': round(percentile(milliseconds, 50), 3),
+                       'p95': round(percentile(milliseconds, 95), 3),
+                       'p99': round(percentile(milliseconds, 99), 3),
+                       'max': round(milliseconds[-1], 3)},
+        'statuses': dict(statuses),
+        'retries': sum(count * number for count, number in retries.items()),
+        'retried_queries': sum(number for count, number in retries.items() if count),
+        'hedged': hedged,
+        'cpu_seconds': round(cpu_seconds, 6),
+        'cpu_per_query_us': round(cpu_seconds / len(latencies) * 1e6, 2),
+    }
+
+
+# Value of a dotted metric name ('latency_ms.p99') in a report
+def metric(results, name):
+    for key in name.split('.'):
+        results = results[key]
+    return results
+
+
+# Change of every compared metric from the baseline report, in percent, and the metrics that got worse by more than
+# max_regression percent
+def compare(results, baseline, max_regression=None):
+    comparison = {}
+    regressions = []
+    for name, higher_is_better in COMPARED_METRICS.items():
+        before = metric(baseline, name)
+        after = metric(results, name)
+        if before:
+            change = round((after - before) / before * 100, 2)
+            worse = -change if higher_is_better else change
+        else:
+            change = None  # no relative change from 0, any change the wrong way is a regression
+            worse = float('inf') if (after < before if higher_is_better else after > before) else 0.0
+        comparison[name] = {'baseline': before, 'current': after, 'change_percent': change}
+
+        if max_regression is not None and worse > max_regression:
+            regressions.append(name)
+    return comparison, regressions
+
+
+def main():
+    args = parse_args()
+    validate_args(args)
+
+    names = query_names(args)
+    process = spawn_server(args) if args.spawn else None
+    try:
+        results = asyncio.run(run_load(args, names))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            results['comparison'], regressions = compare(results, json.load(file), args.max_regression)
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if regressions:
+        print(f"ERROR    Regression over {args.max_regression}% in {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
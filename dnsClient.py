@@ -1,10 +1,34 @@
 import argparse
+import asyncio
+import bisect
+import collections
+import json
+import os
 import random
 import socket
+import struct
 import time
 import sys
 
 
+# Query types the client can ask for and interpret, by name
+QUERY_TYPES = {'A': 0x0001, 'NS': 0x0002, 'CNAME': 0x0005, 'SOA': 0x0006, 'PTR': 0x000c, 'MX': 0x000f,
+               'AAAA': 0x001c}
+TYPE_NAMES = {value: name for name, value in QUERY_TYPES.items()}
+
+# TYPE of the EDNS0 OPT pseudo-record
+OPT_TYPE = 0x0029
+
+# Names of the response codes (RCODE) a server can answer with
+RCODE_NAMES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+RCODES = {name: rcode for rcode, name in RCODE_NAMES.items()}
+
+# IPv4 addresses of the root servers (a to m.root-servers.net), where iterative resolution starts
+ROOT_HINTS = ['198.41.0.4', '170.247.170.2', '192.33.4.12', '199.7.91.13', '192.203.230.10', '192.5.5.241',
+              '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30', '193.0.14.129', '199.7.83.42',
+              '202.12.27.33']
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
@@ -13,14 +37,46 @@ def parse_args():
     parser.add_argument('-r', '--max_retries', type=int, default=3)  # maximum number of times to retransmit an
     # unanswered query before giving up
     parser.add_argument('-p', '--port', type=int, default=53)  # UDP port number of the DNS server
+    parser.add_argument('--payload-size', type=int, default=1232)  # largest UDP response to ask for with EDNS0, 0
+    # to send plain 512-byte queries; truncated responses are retried over TCP either way
+    parser.add_argument('--tcp-connections', type=int, default=4)  # persistent TCP connections per server for the
+    # truncated responses retried over TCP
 
     # Create mutually exclusive group for mx and ns (only one should be true at a time)
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-mx', action='store_true')  # send MX (mail server)
     group.add_argument('-ns', action='store_true')  # send NS (name server)
 
-    parser.add_argument('server', type=str)  # IPv4 address of the DNS server
-    parser.add_argument('name', type=str)  # domain name to query for
+    # Bulk mode: resolve every name of a file (one "name" or "name type" per line) concurrently
+    parser.add_argument('-f', '--file', type=str, default=None)  # file of names to resolve, '-' for stdin
+    parser.add_argument('-c', '--concurrency', type=int, default=100)  # maximum number of queries in flight
+    parser.add_argument('-o', '--output', type=str, default=None)  # file the results are written to (JSON lines),
+    # stdout by default
+
+    # Cache of answers, kept for their TTL
+    parser.add_argument('--cache-size', type=int, default=10000)  # maximum number of cached (name, type) answers
+    parser.add_argument('--cache-file', type=str, default=None)  # load the cache from this file at start and save
+    # it back at exit, so a restarted client starts warm
+    parser.add_argument('--negative-ttl', type=int, default=300)  # seconds NXDOMAIN and empty answers are cached
+
+    # Hedging: when the best server takes longer than this percentile of its recent round-trip times, the query is
+    # also sent to the next best server and the first answer is used (0 to disable)
+    parser.add_argument('--hedge-percentile', type=float, default=95)
+
+    # Iterative mode: start from the root servers and follow referrals down to an authoritative server instead of
+    # asking the server to recurse; the server argument then lists the root servers to start from
+    parser.add_argument('-i', '--iterative', action='store_true')
+
+    # Metrics (latency histograms, retry, error and cache counters) in Prometheus text format
+    parser.add_argument('--metrics-file', type=str, default=None)  # file the metrics are written to at exit, and
+    # every --metrics-interval seconds in bulk mode
+    parser.add_argument('--metrics-interval', type=float, default=10)
+    parser.add_argument('--metrics-port', type=int, default=None)  # serve the metrics over HTTP on this local port
+    # while bulk mode runs
+
+    parser.add_argument('server', type=str)  # IPv4 address of the DNS server, or several separated by commas ('root'
+    # stands for the addresses of the root servers)
+    parser.add_argument('name', type=str, nargs='?')  # domain name to query for (not used in bulk mode)
 
     return parser.parse_args()
 
@@ -39,19 +95,55 @@ def validate_args(args):
         is_error = True
         error += f"ERROR    Max-retries must be non-negative\n"
 
+    # Validate EDNS0 payload size (512 is the size of a plain DNS response)
+    if args.payload_size != 0 and not (512 <= args.payload_size <= 65535):
+        is_error = True
+        error += f"ERROR    Payload size must be 0 or in range [512, 65535]\n"
+
+    if args.tcp_connections < 1:
+        is_error = True
+        error += f"ERROR    TCP connections must be at least 1\n"
+
+    # Validate cache settings
+    if args.cache_size < 0 or args.negative_ttl < 0:
+        is_error = True
+        error += f"ERROR    Cache size and negative TTL must be non-negative\n"
+
+    # Validate concurrency
+    if args.concurrency < 1:
+        is_error = True
+        error += f"ERROR    Concurrency must be at least 1\n"
+
+    # A name is needed unless the names come from a file
+    if args.name is None and args.file is None:
+        is_error = True
+        error += f"ERROR    A domain name (or a file of names with -f) is required\n"
+
     # Validate port number (port)
     if not (0 <= args.port <= 65535):
         is_error = True
         error += f"ERROR    Invalid port number. Must be in range [0, 65535]\n"
 
-    # Validate ip address (server)
-    ip = args.server.lstrip('@')  # remove leading '@' if there is one
-    ip_segments = ip.split('.')
+    if args.metrics_interval <= 0:
+        is_error = True
+        error += f"ERROR    Metrics interval must be positive\n"
+
+    if args.metrics_port is not None and not (0 <= args.metrics_port <= 65535):
+        is_error = True
+        error += f"ERROR    Invalid metrics port number. Must be in range [0, 65535]\n"
 
-    # ip address must be in a.b.c.d format
-    if len(ip_segments) != 4:
+    if not (0 <= args.hedge_percentile < 100):
         is_error = True
-        error += f"ERROR    Invalid server IP address format. Must be in 'a.b.c.d' format\n"
+        error += f"ERROR    Hedge percentile must be in range [0, 100)\n"
+
+    # Validate ip addresses (server)
+    for ip in server_ips(args):
+        ip_segments = ip.split('.')
+
+        # ip address must be in a.b.c.d format
+        if len(ip_segments) != 4:
+            is_error = True
+            error += f"ERROR    Invalid server IP address format {ip!r}. Must be in 'a.b.c.d' format\n"
 
     # only print if an error was encountered
     if is_error:
@@ -59,16 +151,39 @@ def validate_args(args):
         sys.exit(1)
 
 
-# From input arguments, construct packet
-def build_request(args):
+# IP addresses of the servers argument (comma-separated, each with an optional leading '@', 'root' for ROOT_HINTS)
+def server_ips(args):
+    ips = []
+    for server in args.server.split(','):
+        server = server.strip().lstrip('@')
+        ips.extend(ROOT_HINTS if server == 'root' else [server])
+    return ips
+
+
+# Query type asked for by the arguments
+def request_type(args):
+
+    # Change query type field depending on mx/ns field
+    if args.mx:
+        return "MX"
+    elif args.ns:
+        return "NS"
+    return "A"
+
+
+# Construct a query packet for name and q_type, with a random ID unless one is given
+# With payload_size, an EDNS0 OPT record tells the server it may answer with UDP packets of up to that many bytes
+# Without recursion_desired (RD bit clear), the server answers from its own zones or refers to other nameservers
+def build_query(name, q_type, request_id=None, payload_size=None, recursion_desired=True):
 
     # Build header
-    request_id = random.randint(0, 0xFFFF)  # create random 16-bit number
-    flags = 0x0100  # qr, opcode, aa, tc, rd, ra, z and rcode combined into 16-bits
+    if request_id is None:
+        request_id = random.randint(0, 0xFFFF)  # create random 16-bit number
+    flags = 0x0100 if recursion_desired else 0x0000  # qr, opcode, aa, tc, rd, ra, z and rcode combined into 16-bits
     qd_count = 1  # 1 question per packet
     an_count = 0  # only matters for response
     ns_count = 0  # instructions say we can ignore
-    ar_count = 0  # only matters for response
+    ar_count = 0 if payload_size is None else 1  # the OPT record, if any
 
     header = (
         request_id.to_bytes(2, 'big') +  # to_bytes converts int to byte representation
@@ -82,21 +197,7 @@ def build_request(args):
     # Build question
 
     # Encode q_name
-    labels = args.name.split('.')  # split domain name into labels
-    q_name = b''.join(len(label).to_bytes(1, 'big') + label.encode() for label in labels)  # create byte string by
-    # encoding each label into byte representation
-    q_name += b'\x00'  # delimit end of q_name
-
-    # Change query type field depending on mx/ns field
-    if args.mx:
-        q_type = 0x000f  # type-MX query (mail server)
-        request_type = "MX"
-    elif args.ns:
-        q_type = 0x0002  # type-NS query (name server)
-        request_type = "NS"
-    else:
-        q_type = 0x0001  # type-A query (host address)
-        request_type = "A"
+    q_name = encode_name(name)
 
     q_class = 0x0001  # represents an Internet address
 
@@ -106,203 +207,117 @@ def build_request(args):
     # Combine header and question
     packet = header + question
 
-    return packet, request_id
-
+    # EDNS0 OPT pseudo-record: root name, TYPE 41, CLASS holds the UDP payload size, TTL holds the extended RCODE,
+    # version and flags (all 0), no RDATA
+    if payload_size is not None:
+        packet += b'\x00' + OPT_TYPE.to_bytes(2, 'big') + payload_size.to_bytes(2, 'big') + bytes(6)
 
-# Send packet using UDP socket to IP with PORT
-def send_request(args, packet):
-    # Initial printout
-    print(f"DNS client sending request for {args.name}")
-
-    # Strip @ from ip
-    ip = args.server.lstrip('@')
-    print(f"Server: {ip}")
-
-    # Set request type depending on flag
-    if args.mx:
-        request_type = "MX"
-    elif args.ns:
-        request_type = "NS"
-    else:
-        request_type = "A"
+    return packet, request_id
 
-    print(f"Request type: {request_type}")
 
-    # Create UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # AF_INET specifies IPV4 address family, SOCK_DGRAM
-    # specifies UDP socket rather than TCP
-    sock.settimeout(args.timeout)
+# Longest label and name (in wire format, with the length octets and the root label) allowed by RFC 1035
+MAX_LABEL_LENGTH = 63
+MAX_NAME_LENGTH = 255
 
-    num_retries = 0  # keep track of retries
-    start_time = time.time()  # timer
 
-    # If no response within socket timeout, try again up to max_retries attempts
-    while num_retries <= args.max_retries:
+# Bytes of one label of a name: ASCII labels as they are, others converted to their IDNA (punycode) form
+# Lengths are measured on these bytes, not on the characters of the label
+def encode_label(label):
+    try:
+        encoded = label.encode('ascii')
+    except UnicodeEncodeError:
         try:
+            encoded = label.encode('idna')
+        except UnicodeError as e:
+            raise DNSError(f"Label {label!r} can't be encoded as IDNA: {e}") from None
+    if len(encoded) > MAX_LABEL_LENGTH:
+        raise DNSError(f"Label of {len(encoded)} bytes is longer than the maximum of {MAX_LABEL_LENGTH}")
+    return encoded
+
+
+# Wire format of a name: every label prefixed with its length, then the root label
+# A trailing dot is allowed ('' and '.' are the root), an empty label anywhere else is not
+def encode_name(name):
+    labels = name.split('.') if name not in ('', '.') else []
+    if labels and not labels[-1]:
+        labels.pop()  # the trailing dot
+    if not all(labels):
+        raise DNSError(f"Name {name!r} has an empty label")
+    labels = [encode_label(label) for label in labels]
+    encoded = b''.join(len(label).to_bytes(1, 'big') + label for label in labels) + b'\x00'
+    if len(encoded) > MAX_NAME_LENGTH:
+        raise DNSError(f"Name {name!r} is {len(encoded)} bytes long, the maximum is {MAX_NAME_LENGTH}")
+    return encoded
+
+
+# Wire format of a Record read by parse_message, without name compression
+def encode_record(record):
+    if record.type == 0x0001 and '.' in record.data:  # A (one of another length was kept as hex)
+        rdata = socket.inet_pton(socket.AF_INET, record.data)
+    elif record.type == 0x001c and ':' in record.data:  # AAAA
+        rdata = socket.inet_pton(socket.AF_INET6, record.data)
+    elif record.type in (0x0002, 0x0005, 0x000c):  # NS, CNAME, PTR
+        rdata = encode_name(record.data)
+    elif record.type == 0x000f:  # MX
+        rdata = record.preference.to_bytes(2, 'big') + encode_name(record.data)
+    elif record.type == 0x0006:  # SOA
+        rdata = encode_name(record.data[0]) + encode_name(record.data[1]) + SOA_FIELDS.pack(*record.data[2:])
+    else:
+        rdata = bytes.fromhex(record.data)
+    return encode_name(record.name) + RECORD_FIELDS.pack(record.type, record.cls, record.ttl,
+                                                         len(rdata)) + rdata
 
-            # Send DNS query to IP, PORT
-            sock.sendto(packet, (ip, args.port))
-
-            response, _ = sock.recvfrom(512)  # attempt to get a response packet
-
-            print(f"Response received after {time.time() - start_time} seconds ({num_retries} retries)")
-
-            sock.close()  # Close socket once response received
-
-            return response
-
-        # Update number of attempts after failed attempt
-        except socket.timeout:
-            num_retries += 1
-
-        # General error handling for unexpected response
-        except Exception as e:
-            print(f"ERROR   Unexpected response: {e}")
-            sys.exit(1)
-
-    # No success before max retries
-    print(f"ERROR   Maximum number of retries {args.max_retries} exceeded")
-    sock.close()  # close socket if no response
-    sys.exit(1)
-
-
-# Validate response packet
-def validate_response(response, request_id):
-
-    # Response should be at least 12 bytes long
-    if len(response) < 12:
-        print("ERROR: Response packet is too short")
-        return False
-
-    # Response id and request id should match
-    response_id = int.from_bytes(response[:2], 'big')
-    if response_id != request_id:
-        print("ERROR: Response ID does not match request ID")
-        return False
-
-    flags = int.from_bytes(response[2:4], 'big')
-
-    # Check if packet is a response
-    if (flags & 0x8000) == 0:
-        print("ERROR: Response is not a valid DNS response (QR = 0)")
-        return False
-
-    # Check RCODE non-zero (means there is an error)
-    rcode = flags & 0x000F
-    if rcode != 0:
-        print(f"ERROR: DNS query failed with RCODE {rcode}")
-        return False
-
-    return True
-
-
-# Parse all records in Answer and Additional sections
-def parse_response(response):
 
-    # Parse header
-    header = response[:12]
+# Response to a query for name and q_type with the given header flags and sections (lists of Records), for answers
+# put together by the client itself rather than received
+def build_response(message_id, flags, name, q_type, answers=(), authority=(), additional=()):
+    header = HEADER.pack(message_id, flags, 1, len(answers), len(authority), len(additional))
+    question = encode_name(name) + QUESTION_FIELDS.pack(q_type, 0x0001)
+    return header + question + b''.join(encode_record(record) for record in (*answers, *authority, *additional))
 
-    # Get AA (authoritative if True)
-    flags = int.from_bytes(header[2:4], 'big')
-    aa = (flags & 0x0400) >> 2  # 0x04 = 0000 0100, then shift right by 2 to get bit
 
-    # Extract counts from different sections
-    qd_count = int.from_bytes(header[4:6], 'big')  # number of entries in Question section
-    an_count = int.from_bytes(header[6:8], 'big')  # number of resource records in Answer section
-    ns_count = int.from_bytes(header[8:10], 'big')  # number of name server resource records in Authority section
-    ar_count = int.from_bytes(header[10:12], 'big')  # number of resource records in Additional records section
+# Question section of a query built by build_query (the header and OPT record stripped)
+def question_section(packet):
+    index = 12
+    while packet[index] != 0:  # labels of QNAME, build_query never compresses it
+        index += 1 + packet[index]
+    return packet[12:index+5]  # zero-length octet(1) + QTYPE(2) + QCLASS(2)
 
-    # If no Answer or Additional records, exit
-    if an_count == 0 and ar_count == 0:
-        print(f"NOT FOUND")
-        sys.exit(1)
 
-    index = 12  # index keeps track of current byte in response packet (skipped 12 -> header is 12 bytes)
+# The same query without its EDNS0 OPT record (for servers that answer FORMERR to EDNS0)
+def strip_opt(packet):
+    return packet[:10] + b'\x00\x00' + question_section(packet)  # ARCOUNT = 0
 
-    # Skip over Question section
-    for _ in range(qd_count):
-        # Skip QNAME
-        while response[index] != 0:  # 0 indicates the end of QNAME
-            index += 1
 
-        # Skip zero-length octet(1) + QTYPE(2) + QCLASS(2) = 5 bytes
-        index += 5
+# Printout all records of the Answer and Additional sections of a result (the Authority section is not printed)
+def print_result(result):
 
     # Parse Answer section if there is at least one record
+    an_count = len(result.answers)
     if an_count > 0:
         print(f"***Answer Section ({an_count} {'record' if an_count == 1 else 'records'})***")  # print record if 1
         # record, records if more than 1 record
 
-        # Parse all records in Answer section
-        for _ in range(an_count):
-            index = parse_record(response, index, aa)
-
-    # Skip over Authority section
-    for _ in range(ns_count):
-        # Skip NAME
-        while response[index] != 0:
-            index += 1  # NAME is 1 byte long
-
-        # Skip NAME + TYPE(2) + CLASS(2) + TTL(4) = 9 bytes
-        index += 9
-
-        # Get RDLENGTH
-        rd_length = int.from_bytes(response[index:index+2], 'big')  # Skip 2 bytes from RDLENGTH
-
-        # Skip RDLENGTH(2), RDATA(1 * RDLENGTH)
-        index += 2 + rd_length
+        for record in result.answers:
+            print_record(record, result.authoritative)
 
     # Parse Additional section if there is at least one record
+    ar_count = len(result.additional)
     if ar_count > 0:
         print(f"***Additional Section ({ar_count} {'record' if ar_count == 1 else 'records'})***")  # print record if 1
         # record, records if more than 1 record
 
-        # Parse all records in Additional section
-        for _ in range(ar_count):
-            index = parse_record(response, index, aa)
-
-
-# Parse given record and printout record contents
-def parse_record(response, index, aa):
-
-    # Parse NAME
+        for record in result.additional:
+            print_record(record, result.authoritative)
 
-    # Handle name compression
-    if (response[index] & 0xC0) == 0xC0:  # Check if first 2 bits of NAME are 11
-        # Name is a pointer
-        offset = int.from_bytes(response[index:index+2], 'big') & 0x3FFF  # extract 14-bit offset
-        name, _ = parse_name(response, offset)
-        index += 2
 
-    #  No name compression
-    else:
-        name, index = parse_name(response, index)
-
-    # Parse TYPE
-    record_type = int.from_bytes(response[index:index+2], 'big')
-    index += 2
-
-    # Parse CLASS
-    record_class = int.from_bytes(response[index:index+2], 'big')
+# Printout record contents
+def print_record(record, aa):
 
     # Unexpected CLASS
-    if record_class != 0x0001:  # Only handle Internet address
-        print(f"ERROR   Unexpected response: Answer CLASS {record_class} cannot be interpreted. Only 0x0001 (IN) "
-              f"accepted")
-        sys.exit(1)
-    index += 2
-
-    # Parse TTL
-    ttl = int.from_bytes(response[index:index+4], 'big')
-    index += 4
-
-    # Parse RDLENGTH
-    rdlength = int.from_bytes(response[index:index+2], 'big')
-    index += 2
-
-    # Parse RDATA based on TYPE
-    rdata = response[index:index+rdlength]
-    index += rdlength
+    if record.cls != 0x0001:  # Only handle Internet address
+        raise DNSError(f"Unexpected response: Answer CLASS {record.cls} cannot be interpreted. Only 0x0001 (IN) "
+                       f"accepted")
 
     if aa:
         auth = "auth"
@@ -310,64 +325,1359 @@ def parse_record(response, index, aa):
         auth = "nonauth"
 
     # Type A
-    if record_type == 0x0001:
-        ip = ".".join(str(octet) for octet in rdata)
-        print(f"IP  {ip}    {ttl}   {auth}")
+    if record.type == 0x0001:
+        print(f"IP  {record.data}    {record.ttl}   {auth}")
 
     # Type NS
-    elif record_type == 0x0002:
-        ns_name, _ = parse_name(response, index - rdlength)
-        print(f"NS  {ns_name}  {ttl}  {auth}")
+    elif record.type == 0x0002:
+        print(f"NS  {record.data}  {record.ttl}  {auth}")
 
     # Type CNAME
-    elif record_type == 0x0005:
-        cname, _ = parse_name(response, index - rdlength)
-        print(f"CNAME  {cname}  {ttl}  {auth}")
+    elif record.type == 0x0005:
+        print(f"CNAME  {record.data}  {record.ttl}  {auth}")
 
     # Type MX
-    elif record_type == 0x000f:
-        exchange, _ = parse_name(response, index - rdlength + 2)  # first 2 bytes are preference
-        print(f"MX  {exchange}  {ttl}  {auth}")
+    elif record.type == 0x000f:
+        print(f"MX  {record.data}  {record.ttl}  {auth}")
 
     # Unrecognized TYPE
     else:
-        print(f"ERROR   Unexpected response: Unrecognized answer TYPE {record_type}. TYPE must be 0x0001 (A), 0x0002 ("
-              f"NS), 0x0005 (CNAME) or 0x000f (MX)")
-        sys.exit(1)
+        raise DNSError(f"Unexpected response: Unrecognized answer TYPE {record.type}. TYPE must be 0x0001 (A), "
+                       f"0x0002 (NS), 0x0005 (CNAME) or 0x000f (MX)")
+
+
+# Base of the errors raised by the resolver
+class DNSError(Exception):
+    pass
+
+
+# Raised when a query and all its retransmissions went unanswered
+class ResolutionTimeout(DNSError):
+
+    def __init__(self, message, retries, seconds):
+        super().__init__(message)
+        self.retries = retries
+        self.seconds = seconds
+
 
-    return index
+# Raised for a packet that can't be parsed as a DNS message (too short, bad name, compression pointer loop)
+class MalformedResponse(DNSError, ValueError):
+    pass
 
 
-# Resolve name compression
-def parse_name(response, index):
-    labels = []  # store labels
+# Fixed-size parts of a message, read straight out of the packet with unpack_from
+HEADER = struct.Struct('>HHHHHH')  # ID, flags, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT
+QUESTION_FIELDS = struct.Struct('>HH')  # QTYPE, QCLASS (after QNAME)
+RECORD_FIELDS = struct.Struct('>HHIH')  # TYPE, CLASS, TTL, RDLENGTH (after NAME)
+SOA_FIELDS = struct.Struct('>IIIII')  # SERIAL, REFRESH, RETRY, EXPIRE, MINIMUM (after MNAME and RNAME)
+
+
+class Question:
+    __slots__ = ('name', 'type', 'cls')
+
+    def __init__(self, name, q_type, q_class):
+        self.name = name
+        self.type = q_type
+        self.cls = q_class
+
+    def __repr__(self):
+        return f"Question({self.name!r}, {TYPE_NAMES.get(self.type, self.type)})"
+
+
+# One resource record; data depends on the type:
+# A, AAAA: address string, NS, CNAME, PTR: domain name, MX: exchange name (with preference set),
+# SOA: (mname, rname, serial, refresh, retry, expire, minimum), anything else: the RDATA as a hex string
+class Record:
+    __slots__ = ('name', 'type', 'cls', 'ttl', 'data', 'preference')
+
+    def __init__(self, name, record_type, record_class, ttl, data, preference=None):
+        self.name = name
+        self.type = record_type
+        self.cls = record_class
+        self.ttl = ttl
+        self.data = data
+        self.preference = preference
+
+    def __repr__(self):
+        return f"Record({self.name!r}, {TYPE_NAMES.get(self.type, self.type)}, ttl={self.ttl}, data={self.data!r})"
+
+
+# A parsed message; an EDNS0 OPT pseudo-record is kept in opt instead of the Additional section
+class Message:
+    __slots__ = ('id', 'flags', 'questions', 'answers', 'authority', 'additional', 'opt')
+
+    def __init__(self, message_id, flags, questions, answers, authority, additional, opt=None):
+        self.id = message_id
+        self.flags = flags
+        self.questions = questions
+        self.answers = answers
+        self.authority = authority
+        self.additional = additional
+        self.opt = opt
+
+    @property
+    def rcode(self):  # with the upper 8 bits of an extended RCODE from the OPT record
+        extended = 0 if self.opt is None else self.opt.ttl >> 24
+        return (extended << 4) | (self.flags & 0x000F)
+
+    @property
+    def payload_size(self):  # largest UDP message the sender accepts
+        return 512 if self.opt is None else max(self.opt.cls, 512)
+
+    @property
+    def aa(self):  # authoritative answer
+        return bool(self.flags & 0x0400)
+
+    @property
+    def tc(self):  # truncated
+        return bool(self.flags & 0x0200)
+
+
+# Parse a whole response into a Message, reading fields in place through a memoryview
+# Every name decoded is remembered by its offset (for this message only), so names that many records point to
+# (usually the question name) are decoded once
+def parse_message(packet):
+    view = memoryview(packet)
+    names = {}  # offset -> name starting there
+
+    try:
+        message_id, flags, qd_count, an_count, ns_count, ar_count = HEADER.unpack_from(view, 0)
+        index = HEADER.size
+
+        questions = []
+        for _ in range(qd_count):
+            name, index = read_name(view, index, names)
+            q_type, q_class = QUESTION_FIELDS.unpack_from(view, index)
+            index += QUESTION_FIELDS.size
+            questions.append(Question(name, q_type, q_class))
+
+        sections = []
+        for count in (an_count, ns_count, ar_count):
+            records = []
+            for _ in range(count):
+                record, index = read_record(view, index, names)
+                records.append(record)
+            sections.append(records)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise MalformedResponse(f"packet is too short or corrupt ({e})") from None
+
+    answers, authority, additional = sections
+    opt = None
+    for record in additional:
+        if record.type == OPT_TYPE:
+            opt = record
+    if opt is not None:
+        additional = [record for record in additional if record is not opt]
+
+    return Message(message_id, flags, questions, answers, authority, additional, opt)
+
+
+# Read the record at index, returning it and the index after it
+def read_record(view, index, names):
+    name, index = read_name(view, index, names)
+    record_type, record_class, ttl, rdlength = RECORD_FIELDS.unpack_from(view, index)
+    index += RECORD_FIELDS.size
+    end = index + rdlength
+    if end > len(view):
+        raise MalformedResponse(f"record of {name} runs past the end of the packet")
+
+    preference = None
+    if record_type == 0x0001 and rdlength == 4:  # A: IPv4 address
+        data = socket.inet_ntop(socket.AF_INET, view[index:end])
+    elif record_type == 0x001c and rdlength == 16:  # AAAA: IPv6 address
+        data = socket.inet_ntop(socket.AF_INET6, view[index:end])
+    elif record_type in (0x0002, 0x0005, 0x000c):  # NS, CNAME, PTR: a domain name
+        data, _ = read_name(view, index, names)
+    elif record_type == 0x000f:  # MX: 2 bytes of preference, then the exchange
+        preference = int.from_bytes(view[index:index+2], 'big')
+        data, _ = read_name(view, index + 2, names)
+    elif record_type == 0x0006:  # SOA: two names, then five 32-bit fields
+        mname, soa_index = read_name(view, index, names)
+        rname, soa_index = read_name(view, soa_index, names)
+        data = (mname, rname) + SOA_FIELDS.unpack_from(view, soa_index)
+    else:
+        data = view[index:end].hex()
+
+    return Record(name, record_type, record_class, ttl, data, preference), end
+
+
+# Decode the (possibly compressed) name at index, returning it and the index after it in the packet
+# names maps offsets to the names already decoded from them; the suffix starting at every label read here is added
+def read_name(view, index, names):
+    labels = []
+    starts = []  # (offset of a label, number of labels before it)
+    end = None  # index after the name, fixed by the first pointer or the terminating zero
+    suffix = ''
+    jumps = 0
 
     while True:
-        length = response[index]  # retrieve first byte of name
+        if end is not None and index in names:  # rest of the name was decoded before
+            suffix = names[index]
+            break
 
-        # Pointer
-        if (length & 0xC0) == 0xC0:  # if the first 2 bits = '11' name is a pointer
-            offset = int.from_bytes(response[index:index+2], 'big') & 0x3FFF  # retrieve 14 offset bits
-            name, _ = parse_name(response, offset)  # get name from response at pointer location
-            labels.append(name)
-            index += 2  # skip over pointer bytes
-            break  # end of compressed name field
+        length = view[index]
 
-        # Non-compressed name
+        # Pointer: the name continues at the 14-bit offset
+        if (length & 0xC0) == 0xC0:
+            if end is None:
+                end = index + 2
+            jumps += 1
+            if jumps > 127:  # more pointers than a 255-byte name can need, so they loop
+                raise MalformedResponse("compression pointer loop")
+            index = ((length & 0x3F) << 8) | view[index + 1]
 
         # End of name
-        elif length == 0:   # a byte of 0 indicates end of name
-            index += 1  # move past the zero-length octet
-            break  # end of non-compressed name field
+        elif length == 0:
+            if end is None:
+                end = index + 1
+            break
 
-        # Parse next byte of name
-        else:
-            index += 1
-            label = response[index:index+length].decode()  # convert byte to string
-            labels.append(label)
-            index += length  # move index past current label
+        elif length & 0xC0:
+            raise MalformedResponse(f"unsupported label type {length >> 6}")
 
-    return ".".join(labels), index
+        # Next label
+        else:
+            starts.append((index, len(labels)))
+            labels.append(str(view[index+1:index+1+length], 'utf-8'))
+            index += 1 + length
+
+    # Remember the name starting at every label read
+    for offset, position in starts:
+        names[offset] = '.'.join(labels[position:] + ([suffix] if suffix else []))
+
+    name = names[starts[0][0]] if starts else suffix
+    return name, end
+
+
+# Records of the Answer section of a response, as (name, type, TTL, data) tuples
+def read_answers(response):
+    return [(record.name, record.type, record.ttl, record.data) for record in parse_message(response).answers]
+
+
+# Cache of answers keyed by (name, query type), each kept for the smallest TTL of its records
+# NXDOMAIN and empty NOERROR answers are cached too (negative caching), for negative_ttl seconds
+# Holds at most max_entries answers, evicting the least recently used one first
+class ResolverCache:
+
+    def __init__(self, max_entries=10000, negative_ttl=300):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.entries = {}  # (name, type) -> (expiry time, status, answers), least recently used first
+        self.delegations = DelegationCache(max_entries)  # zone cuts found by iterative resolution
+        self.hits = 0
+        self.misses = 0
+
+    # Names are case-insensitive and the trailing dot is optional
+    @staticmethod
+    def key(name, q_type):
+        return name.rstrip('.').lower(), q_type
+
+    # Cached (status, answers) for name and q_type, with the TTLs counted down to the time left, or None
+    def get(self, name, q_type):
+        key = self.key(name, q_type)
+        entry = self.entries.pop(key, None)
+        now = time.time()
+        if entry is None or entry[0] <= now:
+            self.misses += 1
+            return None  # not cached, or expired (and now dropped)
+
+        self.entries[key] = entry  # re-insert as the most recently used
+        self.hits += 1
+        expiry, status, answers = entry
+        remaining = int(expiry - now)
+        return status, [(answer_name, record_type, min(ttl, remaining), data)
+                        for answer_name, record_type, ttl, data in answers]
+
+    # Cache the outcome of a query: answers (as (name, type, TTL, data) tuples) with status NOERROR or NXDOMAIN
+    # Other statuses (SERVFAIL, REFUSED, ...) say nothing about the name and are not cached
+    def put(self, name, q_type, status, answers):
+        if status == 'NOERROR' and answers:
+            ttl = min(answer[2] for answer in answers)
+        elif status in ('NOERROR', 'NXDOMAIN'):
+            ttl = self.negative_ttl
+        else:
+            return
+
+        key = self.key(name, q_type)
+        self.entries.pop(key, None)
+        if ttl <= 0 or self.max_entries == 0:
+            return
+        self.entries[key] = (time.time() + ttl, status, [tuple(answer) for answer in answers])
+
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]  # evict the least recently used answer
+
+    # Write the unexpired answers and delegations to a JSON file (replaced atomically), in least to most recently
+    # used order
+    def save(self, path):
+        now = time.time()
+        entries = [[name, q_type, expiry, status, answers]
+                   for (name, q_type), (expiry, status, answers) in self.entries.items() if expiry > now]
+        delegations = [[zone, expiry, ips] for zone, (expiry, ips) in self.delegations.zones.items() if expiry > now]
+
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump({'version': 1, 'entries': entries, 'delegations': delegations}, file)
+        os.replace(temporary_path, path)
+
+    # Add the unexpired answers of a file written by save (a missing file is an empty cache)
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+
+        with open(path) as file:
+            snapshot = json.load(file)
+
+        now = time.time()
+        for name, q_type, expiry, status, answers in snapshot['entries']:
+            if expiry > now:
+                self.entries[(name, q_type)] = (expiry, status, [tuple(answer) for answer in answers])
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+        for zone, expiry, ips in snapshot.get('delegations', []):  # files saved before iterative mode have none
+            if expiry > now:
+                self.delegations.zones[zone] = (expiry, ips)
+        while len(self.delegations.zones) > self.delegations.max_entries:
+            del self.delegations.zones[next(iter(self.delegations.zones))]
+
+
+# Whether name is zone or inside it (both in lower case without the trailing dot, the root zone being '')
+def in_zone(name, zone):
+    return not zone or name == zone or name.endswith('.' + zone)
+
+
+# Nameserver addresses of the zone cuts met by iterative resolution, keyed by zone (in lower case without the
+# trailing dot) and kept for the smallest TTL of the referral's NS and glue records
+# Holds at most max_entries zones, evicting the least recently used one first
+class DelegationCache:
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.zones = {}  # zone -> (expiry time, nameserver IPs), least recently used first
+
+    # (zone, nameserver IPs) of the deepest unexpired zone cut above or at name, or None if none is known (so
+    # resolution starts at the root)
+    def closest(self, name):
+        labels = name.split('.') if name else []
+        now = time.time()
+        for start in range(len(labels)):
+            zone = '.'.join(labels[start:])
+            entry = self.zones.pop(zone, None)
+            if entry is not None and entry[0] > now:
+                self.zones[zone] = entry  # re-insert as the most recently used
+                return zone, entry[1]
+        return None
+
+    def put(self, zone, ips, ttl):
+        self.zones.pop(zone, None)
+        if ttl <= 0 or self.max_entries == 0:
+            return
+        self.zones[zone] = (time.time() + ttl, list(ips))
+
+        while len(self.zones) > self.max_entries:
+            del self.zones[next(iter(self.zones))]  # evict the least recently used zone
+
+
+# Upper bounds of the histogram buckets of latencies (seconds) and response sizes (bytes)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 1232, 2048, 4096, 8192, 16384, 32768, 65535)
+
+
+# Counts of observed values by bucket (a value falls in the first bucket whose upper bound is at least the value, or
+# in the overflow bucket past the last bound), with their number and sum
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Value below which percentage of the observations lie, interpolated within its bucket (the last bound for
+    # observations past it), None without observations
+    def percentile(self, percentage):
+        if not self.count:
+            return None
+        rank = self.count * percentage / 100
+        below = 0
+        for index, count in enumerate(self.counts[:-1]):
+            if count and below + count >= rank:
+                lower = self.bounds[index - 1] if index else 0
+                return lower + (self.bounds[index] - lower) * (rank - below) / count
+            below += count
+        return self.bounds[-1]
+
+    # Cumulative (upper bound, count of observations up to it) pairs, ending with ('+Inf', count)
+    def buckets(self):
+        cumulative = 0
+        pairs = []
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            pairs.append((bound, cumulative))
+        pairs.append(('+Inf', self.count))
+        return pairs
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': {str(bound): count for bound, count in self.buckets()},
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+
+# What a resolver did: latency histograms per server (round-trip time of each answered transmission) and per record
+# type (whole resolution, retries and fallbacks included), response sizes, and counters of lookups, responses by
+# status, errors, timed out transmissions per server, retries, hedged queries and EDNS0 and TCP fallbacks
+class Metrics:
+
+    def __init__(self):
+        self.server_latency = {}  # (IP, port) -> Histogram of round-trip times
+        self.type_latency = {}  # record type name -> Histogram of resolution times
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.lookups = collections.Counter()  # record type name -> lookups, answered from the cache or not
+        self.responses = collections.Counter()  # status (RCODE name) -> responses
+        self.errors = collections.Counter()  # 'TIMEOUT' or 'MALFORMED' -> lookups that failed so
+        self.timeouts = collections.Counter()  # (IP, port) -> transmissions that went unanswered
+        self.retries = 0
+        self.hedged = 0  # queries that were also sent to a second server
+        self.edns_fallbacks = 0  # queries retried without EDNS0 after a FORMERR
+        self.tcp_fallbacks = 0  # queries retried over TCP after a truncated response
+
+    def observe_rtt(self, address, rtt):
+        histogram = self.server_latency.get(address)
+        if histogram is None:
+            histogram = self.server_latency[address] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(rtt)
+
+    def observe_resolution(self, record_type, seconds):
+        histogram = self.type_latency.get(record_type)
+        if histogram is None:
+            histogram = self.type_latency[record_type] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    # All metrics as a dictionary, with the hits and misses of cache (a ResolverCache) if given
+    def snapshot(self, cache=None):
+        snapshot = {
+            'server_latency_seconds': {f"{ip}:{port}": histogram.as_dict()
+                                       for (ip, port), histogram in self.server_latency.items()},
+            'type_latency_seconds': {record_type: histogram.as_dict()
+                                     for record_type, histogram in self.type_latency.items()},
+            'response_bytes': self.response_bytes.as_dict(),
+            'lookups': dict(self.lookups),
+            'responses': dict(self.responses),
+            'errors': dict(self.errors),
+            'timeouts': {f"{ip}:{port}": count for (ip, port), count in self.timeouts.items()},
+            'retries': self.retries,
+            'hedged': self.hedged,
+            'edns_fallbacks': self.edns_fallbacks,
+            'tcp_fallbacks': self.tcp_fallbacks,
+        }
+        if cache is not None:
+            lookups = cache.hits + cache.misses
+            snapshot['cache'] = {'hits': cache.hits, 'misses': cache.misses, 'entries': len(cache.entries),
+                                 'hit_ratio': cache.hits / lookups if lookups else None}
+        return snapshot
+
+    # All metrics in the Prometheus text exposition format
+    def prometheus(self, cache=None):
+        lines = []
+
+        def header(name, kind, description):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def series(name, labels):
+            return f"{name}{{{','.join(labels)}}}" if labels else name
+
+        def label(key, value):
+            return f'{key}="{value}"'
+
+        def histogram(name, key, histograms, description):
+            header(name, 'histogram', description)
+            for value, histogram in histograms:
+                labels = [label(key, value)] if key else []
+                for bound, count in histogram.buckets():
+                    lines.append(f"{series(name + '_bucket', labels + [label('le', bound)])} {count}")
+                lines.append(f"{series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{series(name + '_count', labels)} {histogram.count}")
+
+        def counter(name, key, counts, description):
+            header(name, 'counter', description)
+            for value, count in counts:
+                lines.append(f"{series(name, [label(key, value)] if key else [])} {count}")
+
+        histogram('dns_client_server_rtt_seconds', 'server',
+                  [(f"{ip}:{port}", histogram) for (ip, port), histogram in self.server_latency.items()],
+                  "Round-trip time of answered queries, by server")
+        histogram('dns_client_resolution_seconds', 'type', self.type_latency.items(),
+                  "Time to resolve a name (retries and fallbacks included), by record type")
+        histogram('dns_client_response_size_bytes', None, [(None, self.response_bytes)], "Size of responses")
+        counter('dns_client_lookups_total', 'type', self.lookups.items(), "Lookups, cached or not, by record type")
+        counter('dns_client_responses_total', 'status', self.responses.items(), "Responses by status (RCODE)")
+        counter('dns_client_errors_total', 'error', self.errors.items(), "Lookups that failed, by error")
+        counter('dns_client_timeouts_total', 'server',
+                [(f"{ip}:{port}", count) for (ip, port), count in self.timeouts.items()],
+                "Transmissions that went unanswered, by server")
+        counter('dns_client_retries_total', None, [(None, self.retries)], "Retransmissions")
+        counter('dns_client_hedged_total', None, [(None, self.hedged)], "Queries also sent to a second server")
+        counter('dns_client_edns_fallbacks_total', None, [(None, self.edns_fallbacks)],
+                "Queries retried without EDNS0")
+        counter('dns_client_tcp_fallbacks_total', None, [(None, self.tcp_fallbacks)], "Queries retried over TCP")
+
+        if cache is not None:
+            counter('dns_client_cache_hits_total', None, [(None, cache.hits)], "Lookups answered from the cache")
+            counter('dns_client_cache_misses_total', None, [(None, cache.misses)], "Lookups not in the cache")
+            lookups = cache.hits + cache.misses
+            header('dns_client_cache_hit_ratio', 'gauge', "Fraction of lookups answered from the cache")
+            lines.append(f"dns_client_cache_hit_ratio {cache.hits / lookups if lookups else 0}")
+
+        return '\n'.join(lines) + '\n'
+
+
+# Lower bound of the retransmission timeout (seconds) derived from a server's round-trip times, leaving room for
+# the event loop to be late with a response when many queries are in flight (the upper bound is the configured
+# timeout)
+MIN_RTO = 0.2
+
+# Number of recent round-trip times kept per server for the hedging percentile, and needed before hedging
+RTT_SAMPLES = 100
+MIN_HEDGE_SAMPLES = 10
+
+# Seconds over which the backoff of a timeout fades out again
+RTO_BACKOFF_DECAY = 30.0
+
+# Every this many queries, one goes first to a server that has not answered yet, so it gets measured
+PROBE_INTERVAL = 16
+
+
+# Round-trip time estimate of one server, as in TCP (RFC 6298): smoothed RTT, its variation and the retransmission
+# timeout (RTO) derived from them, at most max_rto
+# Each query backs off its own retransmissions; a timeout doubles the shared RTO only if the lost transmission was
+# sent after the last doubling, so queries in flight together back it off once per RTO instead of once each
+# Servers are tried in order of smoothed RTT plus what is left of their backoff, so a backed-off server would never
+# be asked (and recover) again while the others answer: the backoff fades out over RTO_BACKOFF_DECAY seconds
+# instead, so it is probed again by then
+class ServerStats:
+
+    def __init__(self, address, initial_rto, max_rto):
+        self.address = address
+        self.srtt = None  # smoothed round-trip time, None until the first answer
+        self.rttvar = None
+        self.estimated_rto = initial_rto  # RTO from the round-trip times, without backoff
+        self.backed_off_rto = None  # RTO after the last timeout, None once an answer arrived since
+        self.backed_off_at = None
+        self.max_rto = max_rto
+        self.samples = collections.deque(maxlen=RTT_SAMPLES)  # recent round-trip times
+        self.timeouts = 0
+
+    @property
+    def rto(self):
+        if self.backed_off_rto is None:
+            return self.estimated_rto
+        remaining = 1 - (time.perf_counter() - self.backed_off_at) / RTO_BACKOFF_DECAY  # fraction of the backoff left
+        return self.estimated_rto + (self.backed_off_rto - self.estimated_rto) * max(remaining, 0.0)
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.estimated_rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), self.max_rto)
+        self.backed_off_rto = None
+        self.samples.append(rtt)
+
+    # Order the server is tried in: its smoothed RTT, raised by the backoff of recent timeouts (servers that never
+    # answered last)
+    @property
+    def rank(self):
+        if self.srtt is None:
+            return float('inf')
+        return self.srtt + self.rto - self.estimated_rto
+
+    # Whether a server that never answered is worth probing: not after a timeout, until its backoff has faded
+    @property
+    def probeable(self):
+        return self.srtt is None and (self.backed_off_at is None or
+                                      time.perf_counter() - self.backed_off_at >= RTO_BACKOFF_DECAY)
+
+    # No response to a transmission sent at sent_at (a time.perf_counter value)
+    def timed_out(self, sent_at):
+        self.timeouts += 1
+        if self.backed_off_at is not None and sent_at < self.backed_off_at:
+            return  # already backed off for a loss of that time
+        self.backed_off_rto = min(self.rto * 2, self.max_rto)
+        self.backed_off_at = time.perf_counter()
+
+    # Round-trip time below which the given percentage of recent answers arrived, None without enough of them
+    def percentile(self, percentage):
+        if len(self.samples) < MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * percentage / 100), len(ordered) - 1)]
+
+
+# Asyncio UDP client keeping many queries in flight on one socket, spread over one or more servers
+# Responses are matched to their query by ID, question section and server address, anything else (a late
+# duplicate of an answered query, a stray packet) is dropped
+class BulkResolver(asyncio.DatagramProtocol):
+
+    # servers are the (IP, port) addresses queries go to unless they name others; timeout is the retransmission
+    # timeout of a server until its round-trip time is known
+    # payload_size is advertised with EDNS0 (None for plain queries); queries whose response was truncated are
+    # retried over a pool of up to tcp_connections persistent TCP connections to that server (None to keep the
+    # truncated response)
+    # hedge_percentile (0 to disable) is the percentile of the best server's round-trip times after which the query
+    # is also sent to the next best server; trace, if given, is called with a line describing every fallback
+    # Round-trip times, timeouts, hedges and fallbacks are counted in metrics (a Metrics, a new one by default)
+    def __init__(self, servers, timeout, max_retries, payload_size=None, tcp_connections=None, hedge_percentile=95,
+                 trace=None, metrics=None):
+        self.addresses = list(servers)
+        self.timeout = timeout
+        self.servers = {}  # address -> ServerStats of every server asked
+        self.max_retries = max_retries
+        self.payload_size = payload_size
+        self.tcp_connections = tcp_connections
+        self.tcp_pools = {}  # address -> TCPPool, opened on the first truncated response from that server
+        self.hedge_percentile = hedge_percentile
+        self.trace = trace
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.transport = None
+        self.pending = {}  # request ID -> (question section, future, send times) of every query in flight
+        self.exchanges = 0  # queries sent so far, to probe unmeasured servers every PROBE_INTERVAL of them
+        self.lookups = {}  # (name, type) -> task of the query in flight for it, shared by identical lookups
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return  # too short to be a DNS response
+
+        entry = self.pending.get(int.from_bytes(data[:2], 'big'))
+        if entry is None:
+            return  # no query in flight with this ID
+        question, future, sent = entry
+
+        if addr not in sent or data[12:12+len(question)] != question or future.done():
+            return
+
+        # Karn's algorithm: only a server asked once gives an unambiguous round-trip time
+        stats, send_time = sent[addr]
+        if send_time is not None:
+            rtt = time.perf_counter() - send_time
+            stats.observe(rtt)
+            self.metrics.observe_rtt(addr, rtt)
+        future.set_result((data, addr))
+
+    def error_received(self, exc):
+        pass  # ICMP errors (e.g. port unreachable) can't be tied to one query, the queries in flight time out instead
+
+    def connection_lost(self, exc):
+        for _, future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("UDP socket closed"))
+
+    # Send a query for name to servers (addresses, the resolver's own by default) and wait for its response,
+    # retransmitting after every timeout
+    # A FORMERR answer to the EDNS0 OPT record is retried without it, and a truncated response over TCP
+    # Returns (response, number of retries, address of the server that answered), response is None if the query
+    # and max_retries retransmissions all went unanswered
+    async def query(self, name, q_type, servers=None, recursion_desired=True):
+        packet, _ = build_query(name, q_type, 0, self.payload_size, recursion_desired)
+        response, retries, address = await self.exchange(packet, servers)
+
+        if response is not None and self.payload_size is not None and (response[3] & 0x0F) == 1:
+            self.log("Server does not support EDNS0, retrying without it")
+            self.metrics.edns_fallbacks += 1
+            packet = strip_opt(packet)
+            response, more_retries, address = await self.exchange(packet, servers)
+            retries += more_retries
+
+        if response is not None and response[2] & 0x02 and self.tcp_connections:
+            self.log("Response truncated, retrying over TCP")
+            self.metrics.tcp_fallbacks += 1
+            try:
+                response = await self.tcp_pool(address).query(packet, self.stats(address).max_rto)
+            except (OSError, asyncio.TimeoutError):
+                pass  # keep the truncated response, its records are still valid
+
+        return response, retries, address
+
+    def log(self, message):
+        if self.trace is not None:
+            self.trace(message)
+
+    # Round-trip time estimate of the server at address, starting from the initial timeout for a new one
+    def stats(self, address):
+        stats = self.servers.get(address)
+        if stats is None:
+            stats = self.servers[address] = ServerStats(address, self.timeout, self.timeout)
+        return stats
+
+    def tcp_pool(self, address):
+        tcp_pool = self.tcp_pools.get(address)
+        if tcp_pool is None:
+            tcp_pool = self.tcp_pools[address] = TCPPool(address, self.tcp_connections)
+        return tcp_pool
+
+    def close_tcp(self):
+        for tcp_pool in self.tcp_pools.values():
+            tcp_pool.close()
+
+    # Send packet (with a new ID, unique among the queries in flight) over UDP to servers and wait for the response
+    # Every transmission goes to the next server in order of rank (fastest first), waiting its RTO, doubled for every
+    # retransmission of this query up to the configured timeout; with hedging, the next server is also asked once
+    # the current one is slower than usual
+    # Every PROBE_INTERVAL queries, a server that has not answered yet is asked first instead, to measure it
+    async def exchange(self, packet, servers=None):
+        request_id = random.randint(0, 0xFFFF)
+        while request_id in self.pending:
+            request_id = random.randint(0, 0xFFFF)
+        packet = request_id.to_bytes(2, 'big') + packet[2:]
+
+        servers = sorted((self.stats(address) for address in servers or self.addresses), key=lambda stats: stats.rank)
+        self.exchanges += 1
+        if self.exchanges % PROBE_INTERVAL == 0:
+            unmeasured = [stats for stats in servers if stats.probeable]
+            if unmeasured:
+                probe = unmeasured[self.exchanges // PROBE_INTERVAL % len(unmeasured)]
+                servers.remove(probe)
+                servers.insert(0, probe)
+        future = asyncio.get_running_loop().create_future()
+        sent = {}  # address -> (stats, send time, or None once sent there twice)
+        self.pending[request_id] = (question_section(packet), future, sent)
+        try:
+            for retries in range(self.max_retries + 1):
+                stats = servers[retries % len(servers)]
+                timeout = min(stats.rto * 2 ** retries, stats.max_rto)
+                sent_at = time.perf_counter()
+                self.send(packet, stats, sent)
+
+                # Hedge: past the usual round-trip time of this server, ask the next one as well
+                delay = stats.percentile(self.hedge_percentile) if self.hedge_percentile and len(servers) > 1 else None
+                if delay is not None and delay < timeout:
+                    try:
+                        response, address = await asyncio.wait_for(asyncio.shield(future), delay)
+                        return response, retries, address
+                    except asyncio.TimeoutError:
+                        self.metrics.hedged += 1
+                        self.send(packet, servers[(retries + 1) % len(servers)], sent)
+                        timeout -= delay
+
+                try:
+                    response, address = await asyncio.wait_for(asyncio.shield(future), timeout)
+                    return response, retries, address
+                except asyncio.TimeoutError:
+                    stats.timed_out(sent_at)  # back off, and retransmit to the next server
+                    self.metrics.timeouts[stats.address] += 1
+
+            return None, self.max_retries, None
+        finally:
+            del self.pending[request_id]
+
+    def send(self, packet, stats, sent):
+        address = stats.address
+        sent[address] = (stats, None if address in sent else time.perf_counter())
+        self.transport.sendto(packet, address)
+
+    # Same as query, but a lookup of a name and type that already has a query in flight waits for that query's
+    # response instead of sending its own
+    async def lookup(self, name, q_type):
+        key = ResolverCache.key(name, q_type)
+        task = self.lookups.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.query(name, q_type))
+            self.lookups[key] = task
+            task.add_done_callback(lambda _: self.lookups.pop(key, None))
+        return await asyncio.shield(task)
+
+
+# Persistent TCP connection to a server, with any number of queries pipelined on it
+# Responses may come back in any order and are matched to their query by ID and question section
+class TCPConnection:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # request ID -> (question section, future) of every query waiting on this connection
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    # Hand every response read to the query waiting for it, until the server closes the connection
+    async def read_responses(self):
+        try:
+            while True:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+                data = await self.reader.readexactly(length)
+                entry = self.pending.get(int.from_bytes(data[:2], 'big'))
+                if entry is None:
+                    continue
+                question, future = entry
+                if data[12:12+len(question)] == question and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass  # closed, by the server (idle timeout) or because of an error
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("TCP connection closed"))
+        self.writer.close()
+        if self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+
+    # Send packet (its ID changed if another query on this connection uses it) and wait for the response
+    async def query(self, packet, timeout):
+        request_id = int.from_bytes(packet[:2], 'big')
+        while request_id in self.pending:
+            request_id = random.randint(0, 0xFFFF)
+        packet = request_id.to_bytes(2, 'big') + packet[2:]
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (question_section(packet), future)
+        try:
+            self.writer.write(len(packet).to_bytes(2, 'big') + packet)  # TCP messages are prefixed with their length
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[request_id]
+
+
+# Pool of up to size persistent TCP connections to one server
+# A query goes to the connection with the fewest queries waiting; a new connection is only opened when every open
+# one is busy, so light traffic shares one connection
+class TCPPool:
+
+    def __init__(self, address, size=4):
+        self.address = address
+        self.size = size
+        self.connections = []
+        self.opening = 0  # connections being opened
+
+    async def connection(self):
+        self.connections = [connection for connection in self.connections if not connection.closed]
+        idle = [connection for connection in self.connections if not connection.pending]
+        if idle:
+            return idle[0]
+
+        if len(self.connections) + self.opening < self.size:
+            self.opening += 1
+            try:
+                reader, writer = await asyncio.open_connection(*self.address)
+            finally:
+                self.opening -= 1
+            connection = TCPConnection(reader, writer)
+            self.connections.append(connection)
+            return connection
+
+        if not self.connections:  # all connections are still being opened
+            await asyncio.sleep(0.01)
+            return await self.connection()
+        return min(self.connections, key=lambda connection: len(connection.pending))
+
+    # Send packet over a pooled connection and wait for the response, on a new connection if the first one closes
+    async def query(self, packet, timeout):
+        for attempt in range(2):
+            connection = await self.connection()
+            try:
+                return await connection.query(packet, timeout)
+            except ConnectionError:
+                if attempt == 1:
+                    raise
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+# Most referrals followed for one name, most nested lookups of nameserver addresses a referral left out, and most
+# CNAME records followed from one name
+MAX_REFERRALS = 16
+MAX_GLUELESS_DEPTH = 3
+MAX_CNAME_CHAIN = 8
+
+
+# Iterative resolution: starting from the root servers, or from the deepest zone cut in the delegation cache, ask
+# each zone's nameservers without recursion and follow their referrals (NS records in the Authority section, the
+# nameservers' addresses from glue A records in the Additional section) down to the servers authoritative for the name
+# Every zone cut found is added to the delegation cache, so later lookups under it skip the servers above it
+class IterativeResolver:
+
+    # resolver is the BulkResolver sending the queries, roots the (IP, port) addresses of the root servers (every
+    # nameserver is asked on the same port); trace, if given, is called with a line describing every step
+    def __init__(self, resolver, roots, delegations, trace=None):
+        self.resolver = resolver
+        self.roots = roots
+        self.port = roots[0][1]
+        self.delegations = delegations
+        self.trace = trace
+        self.lookups = {}  # (name, type) -> task of the resolution in progress for it, shared by identical lookups
+
+    def log(self, message):
+        if self.trace is not None:
+            self.trace(message)
+
+    # Resolve name and q_type, returning (response, number of retries, address of the server that answered) as
+    # BulkResolver.query does; the response is the authoritative answer, NXDOMAIN or NODATA, or SERVFAIL if
+    # resolution got stuck (lame delegation, no nameserver address, too many referrals), so it is never cached
+    # An answer that only aliases name is followed to the canonical name, and returned with the CNAME records first
+    async def resolve(self, name, q_type, depth=0, cnames=0):
+        name = name.rstrip('.').lower()
+        zone, ips = self.delegations.closest(name) or ('', None)
+        servers = self.roots if ips is None else [(ip, self.port) for ip in ips]
+        retries = 0
+
+        for _ in range(MAX_REFERRALS):
+            self.log(f"Asking the nameservers of {zone or '.'} ({', '.join(ip for ip, _ in servers)}) for {name}")
+            response, more_retries, address = await self.resolver.query(name, q_type, servers, False)
+            retries += more_retries
+            if response is None:
+                return None, retries, None
+
+            try:
+                message = parse_message(response)
+            except MalformedResponse:
+                return response, retries, address  # reported by the caller
+
+            if message.answers and message.rcode == 0:
+                return await self.follow_cname(message, response, name, q_type, retries, address, depth, cnames)
+
+            referral = self.referral(message, name, zone)
+            if message.rcode != 0 or (referral is None and message.aa):
+                return response, retries, address
+            if referral is None:
+                self.log(f"Lame delegation: {address[0]} is not authoritative for {name}")
+                return self.servfail(name, q_type), retries, address
+
+            child, ns_names, ttl, glue = referral
+            ips = glue or await self.nameserver_ips(ns_names, depth)
+            if not ips:
+                self.log(f"No address found for the nameservers of {child}")
+                return self.servfail(name, q_type), retries, address
+
+            self.log(f"Referred to {child} ({', '.join(ns_names)})")
+            self.delegations.put(child, ips, ttl)
+            zone, servers = child, [(ip, self.port) for ip in ips]
+
+        self.log(f"Giving up after {MAX_REFERRALS} referrals")
+        return self.servfail(name, q_type), retries, address
+
+    # Response for an answer (message, parsed from response) to name and q_type: the answer itself, unless it only
+    # holds a chain of CNAME records from name, whose canonical name is then resolved in turn
+    async def follow_cname(self, message, response, name, q_type, retries, address, depth, cnames):
+        if q_type == QUERY_TYPES['CNAME']:
+            return response, retries, address
+
+        target = name
+        aliases = {record.name.rstrip('.').lower(): record.data.rstrip('.').lower()
+                   for record in message.answers if record.type == 0x0005}
+        while target in aliases:
+            if cnames >= MAX_CNAME_CHAIN:  # also ends CNAME loops
+                self.log(f"Giving up after {MAX_CNAME_CHAIN} CNAME records")
+                return self.servfail(name, q_type), retries, address
+            target = aliases[target]
+            cnames += 1
+        if target == name or any(record.type == q_type and record.name.rstrip('.').lower() == target
+                                 for record in message.answers):
+            return response, retries, address
+
+        self.log(f"Following CNAME {name} -> {target}")
+        target_response, more_retries, target_address = await self.resolve(target, q_type, depth, cnames)
+        retries += more_retries
+        if target_response is None:
+            return None, retries, None
+        try:
+            target_message = parse_message(target_response)
+        except MalformedResponse:
+            return target_response, retries, target_address
+
+        # The chain found so far, then the canonical name's answer (with its status and authority)
+        chain = [record for record in message.answers if record.type == 0x0005]
+        response = build_response(target_message.id, target_message.flags, name, q_type,
+                                  chain + target_message.answers, target_message.authority, target_message.additional)
+        return response, retries, target_address
+
+    # Response reporting SERVFAIL for name and q_type, for a resolution that got stuck
+    @staticmethod
+    def servfail(name, q_type):
+        return build_response(0, 0x8000 | RCODES['SERVFAIL'], name, q_type)
+
+    # The referral in a response from a nameserver of zone, as (zone cut, nameserver names, TTL, glue IPs), or None
+    # if the response isn't one to a zone below zone and above or at name (an upward or sideways referral would loop)
+    # Glue is only taken for nameservers inside zone, the only names the server that sent it is authoritative for
+    @staticmethod
+    def referral(message, name, zone):
+        ns_records = [record for record in message.authority if record.type == 0x0002]
+        if not ns_records:
+            return None
+
+        child = ns_records[0].name.rstrip('.').lower()
+        if child == zone or not in_zone(child, zone) or not in_zone(name, child):
+            return None
+
+        ns_records = [record for record in ns_records if record.name.rstrip('.').lower() == child]
+        ns_names = [record.data.rstrip('.').lower() for record in ns_records]
+        glue = [record for record in message.additional
+                if record.type == 0x0001 and record.name.rstrip('.').lower() in ns_names
+                and in_zone(record.name.rstrip('.').lower(), zone)]
+
+        ttl = min(record.ttl for record in ns_records + glue)
+        return child, ns_names, ttl, [record.data for record in glue]
+
+    # Addresses of the first of ns_names that resolves (iteratively) to any, for a referral without glue
+    async def nameserver_ips(self, ns_names, depth):
+        if depth >= MAX_GLUELESS_DEPTH:
+            return []
+
+        for ns_name in ns_names:
+            self.log(f"Looking up the address of nameserver {ns_name}")
+            response, _, _ = await self.resolve(ns_name, QUERY_TYPES['A'], depth + 1)
+            if response is None:
+                continue
+            try:
+                ips = [data for _, record_type, _, data in read_answers(response) if record_type == 0x0001]
+            except MalformedResponse:
+                continue
+            if ips:
+                return ips
+        return []
+
+    # Same as resolve, but a lookup of a name and type that is already being resolved waits for that resolution
+    async def lookup(self, name, q_type):
+        key = ResolverCache.key(name, q_type)
+        task = self.lookups.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.resolve(name, q_type))
+            self.lookups[key] = task
+            task.add_done_callback(lambda _: self.lookups.pop(key, None))
+        return await asyncio.shield(task)
+
+
+# Outcome of a resolution: status is the RCODE name ('NOERROR', 'NXDOMAIN', 'SERVFAIL', ...), answers, authority and
+# additional the Records of the response's sections (a result from the cache only has answers)
+# truncated is set when the response was truncated and retrying it over TCP failed, so answers may be incomplete
+class Result:
+    __slots__ = ('name', 'type', 'status', 'rcode', 'answers', 'authority', 'additional', 'authoritative',
+                 'truncated', 'server', 'retries', 'seconds', 'cached')
+
+    def __init__(self, name, record_type, rcode, answers, authority=(), additional=(), authoritative=False,
+                 truncated=False, server=None, retries=0, seconds=0.0, cached=False):
+        self.name = name
+        self.type = record_type
+        self.rcode = rcode
+        self.status = RCODE_NAMES.get(rcode, f"RCODE{rcode}")
+        self.answers = list(answers)
+        self.authority = list(authority)
+        self.additional = list(additional)
+        self.authoritative = authoritative
+        self.truncated = truncated
+        self.server = server
+        self.retries = retries
+        self.seconds = seconds
+        self.cached = cached
+
+    def __repr__(self):
+        return f"Result({self.name!r}, {self.type}, {self.status}, answers={self.answers!r})"
+
+    # Description as a dictionary (a bulk mode result line)
+    def as_dict(self):
+        if self.cached:
+            result = {'name': self.name, 'type': self.type, 'status': self.status, 'cached': True}
+        else:
+            result = {'name': self.name, 'type': self.type, 'retries': self.retries, 'seconds': round(self.seconds, 6),
+                      'server': self.server, 'status': self.status, 'auth': self.authoritative}
+            if self.truncated:
+                result['truncated'] = True
+        result['answers'] = [{'name': record.name, 'type': TYPE_NAMES.get(record.type, record.type),
+                              'ttl': record.ttl, 'data': record.data} for record in self.answers]
+        return result
+
+
+# Resolver for use as a library: resolve(name, type) blocks, aresolve(name, type) is its asyncio counterpart
+# The UDP socket and the pooled TCP connections are opened on first use and kept across calls until close() (one
+# set per event loop, resolve running on a loop of its own), so do reuse a Resolver rather than make one per query
+# Answers come back as Results, failures (no answer, malformed response) are raised as DNSErrors
+class Resolver:
+
+    # servers are IPv4 addresses asked on port (the root servers in iterative mode); cache, if given, is a
+    # ResolverCache answers are looked up in and added to; the other settings are those of BulkResolver
+    # trace, if given, is called with a line describing every fallback and, in iterative mode, every referral
+    # What the resolver does is counted in metrics (a new Metrics by default), see snapshot and prometheus
+    def __init__(self, servers, port=53, timeout=5, max_retries=3, payload_size=1232, tcp_connections=4,
+                 hedge_percentile=95, iterative=False, cache=None, trace=None, metrics=None):
+        self.servers = [(ip, port) for ip in servers]
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.payload_size = payload_size or None
+        self.tcp_connections = tcp_connections
+        self.hedge_percentile = hedge_percentile
+        self.iterative = iterative
+        self.cache = cache
+        self.delegations = cache.delegations if cache is not None else DelegationCache()
+        self.trace = trace
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.loop = None  # event loop of resolve
+        self.channels = {}  # event loop -> task opening (UDP transport, BulkResolver, resolver to look up with)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    # Resolve name and record_type ('A', 'MX', ...) and return the Result
+    def resolve(self, name, record_type='A'):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(self.aresolve(name, record_type))
+
+    async def aresolve(self, name, record_type='A'):
+        q_type = QUERY_TYPES.get(record_type)
+        if q_type is None:
+            raise ValueError(f"Unsupported record type {record_type!r}")
+        self.metrics.lookups[record_type] += 1
+
+        if self.cache is not None:
+            cached = self.cache.get(name, q_type)
+            if cached is not None:
+                status, answers = cached
+                return Result(name, record_type, RCODES[status], [Record(answer_name, answer_type, 0x0001, ttl, data)
+                              for answer_name, answer_type, ttl, data in answers], cached=True)
+
+        lookups = await self.channel()
+        start_time = time.perf_counter()
+        response, retries, address = await lookups.lookup(name, q_type)
+        seconds = time.perf_counter() - start_time
+        self.metrics.retries += retries
+        if response is None:
+            self.metrics.errors['TIMEOUT'] += 1
+            raise ResolutionTimeout(f"Maximum number of retries {self.max_retries} exceeded", retries, seconds)
+
+        self.metrics.observe_resolution(record_type, seconds)
+        self.metrics.response_bytes.observe(len(response))
+        try:
+            message = parse_message(response)
+        except MalformedResponse:
+            self.metrics.errors['MALFORMED'] += 1
+            raise
+        self.metrics.responses[RCODE_NAMES.get(message.rcode, f"RCODE{message.rcode}")] += 1
+
+        result = Result(name, record_type, message.rcode, message.answers, message.authority, message.additional,
+                        message.aa, message.tc, address[0], retries, seconds)
+        if self.cache is not None and not message.tc:
+            self.cache.put(name, q_type, result.status,
+                           [(record.name, record.type, record.ttl, record.data) for record in message.answers])
+        return result
+
+    # Resolver to look up with on the running event loop, opening its socket on first use
+    async def channel(self):
+        loop = asyncio.get_running_loop()
+        channel = self.channels.get(loop)
+        if channel is None:
+            channel = self.channels[loop] = loop.create_task(self.open_channel())
+        _, _, lookups = await asyncio.shield(channel)
+        return lookups
+
+    async def open_channel(self):
+        transport, resolver = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: BulkResolver(self.servers, self.timeout, self.max_retries, self.payload_size,
+                                 self.tcp_connections, self.hedge_percentile, self.trace, self.metrics),
+            local_addr=('0.0.0.0', 0))
+        if self.iterative:
+            return transport, resolver, IterativeResolver(resolver, self.servers, self.delegations, self.trace)
+        return transport, resolver, resolver
+
+    # Queries that were also sent to a second server
+    @property
+    def hedged(self):
+        return self.metrics.hedged
+
+    # Metrics as a dictionary (see Metrics.snapshot), with the cache's hit ratio if there is a cache
+    def snapshot(self):
+        return self.metrics.snapshot(self.cache)
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self):
+        return self.metrics.prometheus(self.cache)
+
+    # Write the metrics in Prometheus text format to path (replaced atomically, for a node exporter's textfile
+    # collector or the like)
+    def write_metrics(self, path):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as file:
+            file.write(self.prometheus())
+        os.replace(temporary_path, path)
+
+    # Close the sockets opened by resolve (they are opened again by the next call)
+    def close(self):
+        if self.loop is not None:
+            self.loop.run_until_complete(self.close_channel())
+            self.loop.close()
+            self.loop = None
+
+    # Close the sockets opened by aresolve on the running event loop
+    async def aclose(self):
+        await self.close_channel()
+
+    async def close_channel(self):
+        channel = self.channels.pop(asyncio.get_running_loop(), None)
+        if channel is not None and channel.done() and not channel.cancelled() and channel.exception() is None:
+            transport, resolver, _ = channel.result()
+            transport.close()
+            resolver.close_tcp()
+            await asyncio.sleep(0)  # let the transports and TCP readers finish closing
+
+
+# Serve the metrics of resolver in Prometheus text format over HTTP (GET /metrics) on host and port, from the running
+# event loop; returns the asyncio server, to be closed when done
+async def serve_metrics(resolver, port, host='127.0.0.1'):
+
+    async def handle(reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass  # headers
+            if len(request) >= 2 and request[0] == b'GET' and request[1].split(b'?')[0] in (b'/', b'/metrics'):
+                status, body = "200 OK", resolver.prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# Resolver with the settings of the arguments
+def open_resolver(args, cache=None, trace=None):
+    return Resolver(server_ips(args), args.port, args.timeout, args.max_retries, args.payload_size,
+                    args.tcp_connections, args.hedge_percentile, args.iterative, cache, trace)
+
+
+# Resolve one name in bulk mode and describe the result, or the error, as a dictionary (written out as one JSON line)
+async def resolve_one(resolver, name, request_type):
+    try:
+        return (await resolver.aresolve(name, request_type)).as_dict()
+    except ResolutionTimeout as e:
+        return {'name': name, 'type': request_type, 'retries': e.retries, 'seconds': round(e.seconds, 6),
+                'status': 'TIMEOUT'}
+    except MalformedResponse:
+        return {'name': name, 'type': request_type, 'status': 'MALFORMED'}
+    except Exception as e:  # an invalid name, or anything else, fails only this name rather than its task
+        return {'name': name, 'type': request_type, 'status': 'ERROR', 'error': str(e)}
+
+
+# Bulk mode: resolve every name of lines (a file of "name" or "name type" lines) with at most args.concurrency
+# queries in flight on one UDP socket (shared by all servers), writing each result to output as soon as it arrives
+# (in completion order)
+# Lines are read in a background thread, and only when there is a free slot, so a slow or endless stdin neither
+# blocks the event loop nor gets read ahead of the queries
+# Meanwhile the metrics are served on args.metrics_port and written to args.metrics_file every args.metrics_interval
+# seconds, if asked for
+async def resolve_bulk(args, lines, output, default_type, cache):
+    loop = asyncio.get_running_loop()
+    resolver = open_resolver(args, cache)
+    metrics_server = None if args.metrics_port is None else await serve_metrics(resolver, args.metrics_port)
+    metrics_writer = None
+    if args.metrics_file is not None:
+        metrics_writer = asyncio.create_task(write_metrics_periodically(resolver, args.metrics_file,
+                                                                        args.metrics_interval))
+    slots = asyncio.Semaphore(args.concurrency)
+    tasks = set()  # queries in flight
+
+    def write(result):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    async def run(name, request_type):
+        try:
+            write(await resolve_one(resolver, name, request_type))
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            await slots.acquire()
+            line = await loop.run_in_executor(None, lines.readline)
+            if not line:
+                slots.release()
+                break
+
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):  # skip blank lines and comments
+                slots.release()
+                continue
+
+            name = fields[0]
+            request_type = fields[1].upper() if len(fields) > 1 else default_type
+            if request_type not in QUERY_TYPES:
+                write({'name': name, 'type': request_type, 'status': 'UNSUPPORTED TYPE'})
+                slots.release()
+                continue
+
+            task = asyncio.create_task(run(name, request_type))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        await resolver.aclose()
+        if metrics_server is not None:
+            metrics_server.close()
+        if metrics_writer is not None:
+            metrics_writer.cancel()
+            resolver.write_metrics(args.metrics_file)
+
+
+async def write_metrics_periodically(resolver, path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        resolver.write_metrics(path)
+
+
+# Run bulk mode with the input and output files of the arguments
+def run_bulk(args):
+    cache = open_cache(args)
+    lines = sys.stdin if args.file == '-' else open(args.file)
+    output = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        asyncio.run(resolve_bulk(args, lines, output, request_type(args), cache))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+        if args.cache_file is not None:
+            cache.save(args.cache_file)
+
+
+# Cache for the arguments, loaded from the cache file if there is one
+def open_cache(args):
+    cache = ResolverCache(args.cache_size, args.negative_ttl)
+    if args.cache_file is not None:
+        cache.load(args.cache_file)
+    return cache
 
 
 def main():
@@ -377,21 +1687,56 @@ def main():
     # Validate input
     validate_args(args)
 
-    # Construct request packet
-    packet, request_id = build_request(args)
+    # Bulk mode: resolve every name of a file instead of a single one
+    if args.file is not None:
+        run_bulk(args)
+        return
 
-    # Send request packet using sockets
-    response = send_request(args, packet)
+    # Initial printout
+    if args.iterative:
+        print(f"DNS client resolving {args.name} iteratively")
+        print(f"Root servers: {', '.join(server_ips(args))}")
+    else:
+        print(f"DNS client sending request for {args.name}")
+        print(f"Server: {', '.join(server_ips(args))}")
+    print(f"Request type: {request_type(args)}")
+
+    # Answers are looked up in and added to the cache file, if there is one
+    cache = open_cache(args) if args.cache_file is not None else None
+
+    resolver = open_resolver(args, cache, print)
+    try:
+        result = resolver.resolve(args.name, request_type(args))
+    except DNSError as e:
+        print(f"ERROR   {e}")
+        sys.exit(1)
+    finally:
+        resolver.close()
+        if cache is not None:
+            cache.save(args.cache_file)
+        if args.metrics_file is not None:
+            resolver.write_metrics(args.metrics_file)
+
+    if result.cached:
+        print(f"Answered from cache")
+    else:
+        print(f"Response received after {result.seconds} seconds ({result.retries} retries)")
 
-    # Validate response packet
-    valid = validate_response(response, request_id)
+    # A response with an error RCODE has nothing to print
+    if result.rcode != 0:
+        print(f"ERROR: DNS query failed with RCODE {result.rcode}")
+        sys.exit(1)
 
-    # If response packet is invalid, exit
-    if not valid:
+    # If no Answer or Additional records, exit
+    if not result.answers and not result.additional:
+        print(f"NOT FOUND")
         sys.exit(1)
 
-    # Parse response
-    parse_response(response)
+    try:
+        print_result(result)
+    except DNSError as e:
+        print(f"ERROR   {e}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
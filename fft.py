@@ -1,19 +1,129 @@
 import argparse
+import contextlib
+import functools
+import glob
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import image as mpimg
-from matplotlib.colors import LogNorm
-import matplotlib.image as mpim
 import time
 
-
-# Pad image with 0s such that the dimensions of the image are powers of 2
-def pad_image(image):
+# matplotlib is only imported by the functions that read, write or plot images, so headless runs never load pyplot
+
+
+# Stage profile while profiling is on (see start_profile): stage name -> calls, wall time and peak allocation
+_profile = None
+_open_stages = []  # [start of the stage's allocations, highest allocation seen in it] of every open stage
+
+
+def start_profile():
+    global _profile
+    _profile = {}
+    _open_stages.clear()
+    tracemalloc.start()  # traces every allocation (numpy buffers included) until stop_profile
+
+
+# Stop profiling and return the report: per stage, the number of calls, the total wall time and the peak number
+# of bytes allocated above what was allocated when the stage started (worker processes are not traced)
+def stop_profile():
+    global _profile
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report = {"stages": _profile, "peak_bytes": peak}
+    _profile = None
+    return report
+
+
+# Record the code run inside as one call of the named stage (a no-op unless profiling is on)
+# Stages may be nested, an outer stage's time and peak include those of its inner stages
+@contextlib.contextmanager
+def profile_stage(name):
+    if _profile is None:
+        yield
+        return
+
+    current, peak = tracemalloc.get_traced_memory()
+    for stage in _open_stages:
+        stage[1] = max(stage[1], peak)  # the peak counter is reset below, fold it into the open stages first
+    tracemalloc.reset_peak()
+    stage = [current, current]
+    _open_stages.append(stage)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        _open_stages.pop()
+        for open_stage in _open_stages:
+            open_stage[1] = max(open_stage[1], peak)
+
+        entry = _profile.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_bytes": 0})
+        entry["calls"] += 1
+        entry["seconds"] += elapsed
+        entry["peak_bytes"] = max(entry["peak_bytes"], max(stage[1], peak) - stage[0])
+
+
+# Decorator recording every call of a function as one call of the named stage
+def profiled(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Print a profile report as a table, stages in order of total time
+def print_profile(report):
+    print(f"{'stage':<22}{'calls':>8}{'time (s)':>14}{'peak (MB)':>14}")
+    for name, entry in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{name:<22}{entry['calls']:>8}{entry['seconds']:>14.4f}{entry['peak_bytes'] / 2 ** 20:>14.2f}")
+
+
+# Smallest length >= n whose prime factors are all at most 7, which the mixed-radix FFT transforms fastest
+def next_fast_len(n):
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))  # a power of 2 always works
+    power_of_7 = 1
+    while power_of_7 < best:
+        power_of_5 = power_of_7
+        while power_of_5 < best:
+            power_of_3 = power_of_5
+            while power_of_3 < best:
+                # Smallest power of 2 that brings this candidate up to n
+                candidate = power_of_3
+                while candidate < n:
+                    candidate *= 2
+                best = min(best, candidate)
+                power_of_3 *= 3
+            power_of_5 *= 5
+        power_of_7 *= 7
+    return best
+
+
+# Pad image with 0s to a size that transforms faster
+# The FFT handles any size, so padding is only a speed optimization:
+# mode "pow2" pads to the next powers of 2, mode "fast" to the next 7-smooth sizes (usually much smaller)
+@profiled("pad")
+def pad_image(image, mode="pow2"):
     h, w = image.shape[:2]
 
-    # Find the next power of 2 for height and width
-    new_h = 2 ** np.ceil(np.log2(h)).astype(int)
-    new_w = 2 ** np.ceil(np.log2(w)).astype(int)
+    # Find the padded height and width
+    if mode == "pow2":
+        new_h = 2 ** np.ceil(np.log2(h)).astype(int)
+        new_w = 2 ** np.ceil(np.log2(w)).astype(int)
+    elif mode == "fast":
+        new_h = next_fast_len(h)
+        new_w = next_fast_len(w)
+    else:
+        raise ValueError(f"Unknown padding mode {mode!r}")
 
     # Calculate padding needed
     pad_height = new_h - h
@@ -28,79 +138,736 @@ def pad_image(image):
     return padded_image
 
 
-# Naive implementation of DFT
-def dft_naive(x):
-    N = len(x)  # number of samples
-    X = np.zeros(N, dtype=complex)  # initialize empty array, one value for each sample
+# Memory (in bytes) the naive DFT may spend on one block of its DFT matrix
+DFT_MEMORY_BUDGET = 64 * 2 ** 20
 
-    for k in range(N):  # For each output frequency
-        for n in range(N):  # For each input sample
-            exponent = -2j * np.pi * k * n / N  # Compute exponent
-            X[k] += x[n] * np.exp(exponent)  # Multiply and accumulate output value
 
-    return X
+# Naive implementation of DFT, X[k] = sum_n x[n] * exp(-2 pi i k n / N), as a DFT matrix product
+# Works over the given axis of an N-d input (every other axis is treated as a batch); the DFT matrix is built
+# a block of rows (output frequencies) at a time so that no block takes more than memory_budget bytes
+def dft_naive(x, axis=-1, memory_budget=DFT_MEMORY_BUDGET):
+    x = np.moveaxis(np.asarray(x, dtype=complex), axis, -1)
+    N = x.shape[-1]  # number of samples
+    X = np.empty_like(x)  # one value for each sample
 
+    samples = np.arange(N)
+    block_size = max(1, memory_budget // (16 * max(N, 1)))  # complex128 takes 16 bytes
+    for start in range(0, N, block_size):
+        frequencies = np.arange(start, min(start + block_size, N))
 
-# FFT
-# Algorithm implementation inspired by Carleton University:
-# https://people.scs.carleton.ca/~maheshwa/courses/5703COMP/16Fall/FFT_Report.pdf
-def fft(x):
-    n = len(x)
+        # Exponents of this block of rows, with k * n reduced mod N first to keep the phase exact
+        exponents = -2j * np.pi * (np.outer(frequencies, samples) % N) / N
+        X[..., start:start + len(frequencies)] = x @ np.exp(exponents).T  # multiply and accumulate every output
+
+    return np.moveaxis(X, -1, axis)
+
+
+# Naive 2d DFT: dft_naive on all rows at once, then on all columns at once
+def dft2_naive(image, axes=(-2, -1), memory_budget=DFT_MEMORY_BUDGET):
+    transformed_rows = dft_naive(image, axis=axes[1], memory_budget=memory_budget)
+    return dft_naive(transformed_rows, axis=axes[0], memory_budget=memory_budget)
+
+
+# Size of the blocks transformed directly (as a small DFT matrix product) before the radix-2 butterfly stages
+LEAF_SIZE = 16
+
+# Maximum number of FFT plans (one per size and direction) kept by get_plan
+PLAN_CACHE_SIZE = 32
+
+# Sizes whose prime factors are all at most this are transformed by the mixed-radix plan, others by Bluestein's
+# (a direct p-point DFT matrix product stays faster than Bluestein's three padded FFTs up to a few hundred)
+MAX_PRIME_RADIX = 257
 
-    if n <= 1:
-        return x
 
-    w_n = np.exp(-2j * np.pi / n)
-    w = 1
+# Prime factors of n in increasing order
+def prime_factors(n):
+    factors = []
+    p = 2
+    while p * p <= n:
+        while n % p == 0:
+            factors.append(p)
+            n //= p
+        p += 1
+    if n > 1:
+        factors.append(n)
+    return factors
 
-    y_even = fft(x[::2])  # recursively call fft on even-index elements
-    y_odd = fft(x[1::2])  # on odd-index elements
 
-    y = np.zeros(n, dtype=complex)  # initialize values
-    for j in range(n // 2):
-        y[j] = y_even[j] + w * y_odd[j]
-        y[j + n // 2] = y_even[j] - w * y_odd[j]
-        w = w * w_n
-    return y
+# Bit-reversal permutation of the indices 0..n-1 (n must be a power of 2)
+def bit_reverse_indices(n):
+    reversed_indices = np.zeros(1, dtype=int)
+    while len(reversed_indices) < n:  # permutation for 2m indices: evens take the m-permutation doubled, odds + 1
+        reversed_indices = np.concatenate((2 * reversed_indices, 2 * reversed_indices + 1))
+    return reversed_indices
 
 
-# Perform inverse fft for 1d input
-def ifft(x):
-    n = len(x)
+# Complex dtype a transform computes in: the dtype asked for, else that of out, else complex128
+# complex64 halves the memory (and memory bandwidth) of every buffer, at single precision
+def _complex_dtype(dtype=None, out=None):
+    if dtype is None:
+        dtype = out.dtype if out is not None else np.complex128
+    dtype = np.dtype(dtype)
+    if dtype.kind != "c":
+        raise ValueError(f"Transform dtype must be complex, got {dtype}")
+    return dtype
 
-    if n <= 1:
+
+# Precomputed tables for transforming length-n signals in one direction
+# Iterative radix-2 Cooley-Tukey, inspired by the recursive algorithm from Carleton University:
+# https://people.scs.carleton.ca/~maheshwa/courses/5703COMP/16Fall/FFT_Report.pdf
+class FFTPlan:
+    def __init__(self, n, inverse=False):
+        if n < 1 or n & (n - 1):
+            raise ValueError(f"FFT size must be a power of 2, got {n}")
+
+        self.n = n
+        self.inverse = inverse
+        sign = 1 if inverse else -1
+
+        self.permutation = bit_reverse_indices(n)  # reorders input so each butterfly stage combines adjacent blocks
+
+        # Every twiddle factor needed, w_n^k for k < n/2, each computed directly rather than by repeated
+        # multiplication so that rounding error does not build up along the row
+        self.twiddles = np.exp(sign * 2j * np.pi * np.arange(n // 2) / n)
+
+        # Every block of leaf values holds a bit-reversed sub-sequence, so the rows of its DFT matrix are bit-reversed
+        self.leaf = min(n, LEAF_SIZE)
+        self.leaf_matrix = np.exp(sign * 2j * np.pi * np.outer(bit_reverse_indices(self.leaf),
+                                                               np.arange(self.leaf)) / self.leaf)
+
+        # Plans are shared between callers through the cache, so their tables must never change
+        for table in (self.permutation, self.twiddles, self.leaf_matrix):
+            table.flags.writeable = False
+
+    def __repr__(self):
+        return f"FFTPlan(n={self.n}, inverse={self.inverse})"
+
+    # Transform x over its last axis (any leading axes are treated as a batch)
+    # The result is computed in dtype (complex128 by default) and written into out when it is given, which may be x
+    # itself; two full-size buffers are used in turn, with out as one of them when it is contiguous
+    def execute(self, x, out=None, dtype=None):
+        dtype = _complex_dtype(dtype, out)
+        x = np.asarray(x)
+        n = self.n
+
+        if x.shape[-1] != n:
+            raise ValueError(f"Plan is for size {n}, got input of size {x.shape[-1]}")
+
+        batch_shape = x.shape[:-1]
+        twiddles = self.twiddles.astype(dtype, copy=False)
+        leaf_matrix = self.leaf_matrix.astype(dtype, copy=False)
+
+        # Pick the buffer order so that the last stage writes into result: the leaf product goes into the second
+        # buffer and every butterfly stage swaps them
+        stages = (n // self.leaf).bit_length() - 1
+        direct = out is not None and out.flags.c_contiguous and out.dtype == dtype
+        result = out if direct else np.empty(x.shape, dtype)
+        other = np.empty(x.shape, dtype)
+        first, second = (other, result) if stages % 2 == 0 else (result, other)
+
+        # Reorder input so each butterfly stage combines adjacent blocks (a buffered gather when x overlaps first)
+        if x.dtype == dtype:
+            np.take(x, self.permutation, axis=-1, out=first, mode="raise" if np.shares_memory(x, first) else "clip")
+        else:
+            first[...] = x[..., self.permutation]
+
+        # First stages: transform every block of leaf values at once with one matrix product
+        np.matmul(first.reshape(batch_shape + (n // self.leaf, self.leaf)), leaf_matrix,
+                  out=second.reshape(batch_shape + (n // self.leaf, self.leaf)))
+        y, spare = second, first
+        odd = np.empty(batch_shape + (n // 2,), dtype)  # w * odd of the current stage
+
+        half = self.leaf  # size of the sub-transforms being combined in this stage
+        while half < n:
+            w = twiddles[::n // (2 * half)]  # twiddle factors of this stage, w_(2 * half)^k for k < half
+
+            # Split every block of 2 * half values into its even (first half) and odd (second half) sub-transform
+            blocks = y.reshape(batch_shape + (n // (2 * half), 2, half))
+            combined = spare.reshape(blocks.shape)
+            even = blocks[..., 0, :]
+            weighted_odd = odd.reshape(batch_shape + (n // (2 * half), half))
+            np.multiply(blocks[..., 1, :], w, out=weighted_odd)
+
+            # Butterfly: first half gets even + w * odd, second half gets even - w * odd
+            np.add(even, weighted_odd, out=combined[..., 0, :])
+            np.subtract(even, weighted_odd, out=combined[..., 1, :])
+            y, spare = spare, y
+            half *= 2
+
+        if self.inverse:
+            y /= n
+
+        if out is not None and not direct:
+            out[...] = y
+            return out
+        return y
+
+
+# Precomputed tables for transforming length-n signals whose prime factors are all small
+# Decimation in time over radices p: split x into the p sub-sequences x[r::p], transform each (recursively over the
+# remaining radices), multiply by the twiddles w_n^(r * k) and combine them with one p-point DFT matrix product
+class MixedRadixPlan:
+    def __init__(self, n, inverse=False):
+        factors = prime_factors(n)
+        if n < 2 or factors[-1] > MAX_PRIME_RADIX:
+            raise ValueError(f"Mixed-radix FFT size must be >= 2 with prime factors <= {MAX_PRIME_RADIX}, got {n}")
+
+        self.n = n
+        self.inverse = inverse
+        sign = 1 if inverse else -1
+
+        # Group the prime factors into radices of at most LEAF_SIZE, so fewer (larger) DFT matrix products are needed
+        self.radices = []
+        for p in factors:
+            if self.radices and self.radices[-1] * p <= LEAF_SIZE:
+                self.radices[-1] *= p
+            else:
+                self.radices.append(p)
+
+        # One level per radix: (p, m, twiddles w_n^(r * k) of shape (p, m), p-point DFT matrix)
+        self.levels = []
+        size = n
+        for p in self.radices:
+            m = size // p
+            twiddles = np.exp(sign * 2j * np.pi * np.outer(np.arange(p), np.arange(m)) / size)
+            dft_matrix = np.exp(sign * 2j * np.pi * np.outer(np.arange(p), np.arange(p)) / p)
+            twiddles.flags.writeable = False
+            dft_matrix.flags.writeable = False
+            self.levels.append((p, m, twiddles, dft_matrix))
+            size = m
+
+    def __repr__(self):
+        return f"MixedRadixPlan(n={self.n}, inverse={self.inverse}, radices={self.radices})"
+
+    # Transform x over its last axis (any leading axes are treated as a batch), in dtype and into out if given
+    def execute(self, x, out=None, dtype=None):
+        dtype = _complex_dtype(dtype, out)
+        x = np.asarray(x, dtype=dtype)
+        if x.shape[-1] != self.n:
+            raise ValueError(f"Plan is for size {self.n}, got input of size {x.shape[-1]}")
+
+        y = self._execute_level(x, 0, dtype)
+        if self.inverse:
+            y /= self.n
+
+        if out is not None:
+            out[...] = y
+            return out
+        return y
+
+    def _execute_level(self, x, level, dtype):
+        if level == len(self.levels):
+            return x  # a 1-point transform is the identity
+
+        p, m, twiddles, dft_matrix = self.levels[level]
+        batch_shape = x.shape[:-1]
+
+        sub_sequences = np.swapaxes(x.reshape(batch_shape + (m, p)), -1, -2)  # row r holds x[r::p]
+        y = self._execute_level(sub_sequences, level + 1, dtype) * twiddles.astype(dtype, copy=False)
+        y = dft_matrix.astype(dtype, copy=False) @ y
+        return y.reshape(batch_shape + (p * m,))  # X[k2 * m + k1] is row k2, column k1
+
+
+# Precomputed tables for transforming length-n signals of any size with Bluestein's chirp-z algorithm
+# jk = (j^2 + k^2 - (k - j)^2) / 2 turns the DFT into a convolution with a chirp, which is computed with
+# power-of-2 FFTs of size m >= 2n - 1
+class BluesteinPlan:
+    def __init__(self, n, inverse=False):
+        if n < 1:
+            raise ValueError(f"FFT size must be positive, got {n}")
+
+        self.n = n
+        self.inverse = inverse
+        sign = 1 if inverse else -1
+
+        m = 2 ** int(np.ceil(np.log2(2 * n - 1)))
+        self.forward_plan = get_plan(m)
+        self.inverse_plan = get_plan(m, inverse=True)
+
+        # Chirp c_k = exp(sign * i * pi * k^2 / n), with k^2 reduced mod 2n first to keep the phase exact
+        k = np.arange(n)
+        self.chirp = np.exp(sign * 1j * np.pi * ((k * k) % (2 * n)) / n)
+
+        # Spectrum of the conjugate chirp, laid out circularly so the convolution is circular of size m
+        kernel = np.zeros(m, dtype=complex)
+        kernel[:n] = np.conj(self.chirp)
+        kernel[m - n + 1:] = np.conj(self.chirp[1:][::-1])
+        self.kernel_spectrum = self.forward_plan.execute(kernel)
+
+        self.chirp.flags.writeable = False
+        self.kernel_spectrum.flags.writeable = False
+
+    def __repr__(self):
+        return f"BluesteinPlan(n={self.n}, inverse={self.inverse})"
+
+    # Transform x over its last axis (any leading axes are treated as a batch), in dtype and into out if given
+    def execute(self, x, out=None, dtype=None):
+        dtype = _complex_dtype(dtype, out)
+        x = np.asarray(x)
+        n = self.n
+        if x.shape[-1] != n:
+            raise ValueError(f"Plan is for size {n}, got input of size {x.shape[-1]}")
+
+        chirp = self.chirp.astype(dtype, copy=False)
+        padded = np.zeros(x.shape[:-1] + (self.forward_plan.n,), dtype=dtype)
+        np.multiply(x, chirp, out=padded[..., :n])
+
+        # Convolve with the chirp, reusing the padded buffer for both power-of-2 transforms
+        self.forward_plan.execute(padded, out=padded)
+        padded *= self.kernel_spectrum.astype(dtype, copy=False)
+        self.inverse_plan.execute(padded, out=padded)
+
+        if out is None:
+            out = np.empty(x.shape, dtype)
+        np.multiply(padded[..., :n], chirp, out=out)
+        if self.inverse:
+            out /= n
+        return out
+
+
+# Get the plan for size n and direction, reusing a cached one when possible (least recently used plans are evicted)
+# Powers of 2 use the radix-2 plan, sizes with only small prime factors the mixed-radix plan, and others Bluestein's
+def get_plan(n, inverse=False):
+    return _build_plan(int(n), bool(inverse))
+
+
+# The cache is keyed on the exact call, so get_plan normalizes its arguments to one positional form first
+# (get_plan(m), get_plan(m, False) and get_plan(m, inverse=False) must share one entry)
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _build_plan(n, inverse):
+    if n & (n - 1) == 0:
+        return FFTPlan(n, inverse)
+    if prime_factors(n)[-1] <= MAX_PRIME_RADIX:
+        return MixedRadixPlan(n, inverse)
+    return BluesteinPlan(n, inverse)
+
+
+# Precomputed tables for transforming real length-n signals through a complex transform of size n/2
+# The even and odd samples are packed into the real and imaginary parts of one half-length signal, and
+# Hermitian symmetry is used to split its spectrum back apart, so only n/2 + 1 outputs are computed and stored
+# Odd sizes cannot be packed and go through a full-size complex transform instead
+class RealFFTPlan:
+    def __init__(self, n, inverse=False):
+        if n < 2:
+            raise ValueError(f"Real FFT size must be at least 2, got {n}")
+
+        self.n = n
+        self.inverse = inverse
+
+        if n % 2:
+            self.full_plan = get_plan(n, inverse)
+            return
+        self.half_plan = get_plan(n // 2, inverse)
+
+        # w_n^k for k = 0..n/2, which combines the spectra of the even and odd samples
+        self.split_twiddles = np.exp(-2j * np.pi * np.arange(n // 2 + 1) / n)
+        self.split_twiddles.flags.writeable = False
+
+    def __repr__(self):
+        return f"RealFFTPlan(n={self.n}, inverse={self.inverse})"
+
+    # Real signal (..., n) -> first n/2 + 1 values of its spectrum (the rest are their complex conjugates)
+    # dtype is the complex dtype of the spectrum (complex128 by default, complex64 for single precision)
+    def execute(self, x, dtype=None):
+        dtype = _complex_dtype(dtype)
+        x = np.asarray(x, dtype=np.finfo(dtype).dtype)
+        half = self.n // 2
+
+        if self.n % 2:
+            return self.full_plan.execute(x, dtype=dtype)[..., :half + 1]
+
+        # Pack the even samples into the real and the odd samples into the imaginary parts
+        packed = np.empty(x.shape[:-1] + (half + 1,), dtype)
+        packed.real[..., :half] = x[..., 0::2]
+        packed.imag[..., :half] = x[..., 1::2]
+        self.half_plan.execute(packed[..., :half], out=packed[..., :half])
+        packed[..., half] = packed[..., 0]  # Z[n/2] = Z[0], the spectrum is periodic
+        mirrored = np.conj(packed[..., ::-1])  # conj(Z[n/2 - k])
+
+        even = (packed + mirrored) / 2  # spectrum of the even samples
+        odd = (packed - mirrored) / 2j  # spectrum of the odd samples
+        return even + self.split_twiddles.astype(dtype, copy=False) * odd
+
+    # First n/2 + 1 values of a Hermitian spectrum (..., n/2 + 1) -> real signal (..., n)
+    def execute_inverse(self, spectrum, dtype=None):
+        dtype = _complex_dtype(dtype)
+        spectrum = np.asarray(spectrum, dtype=dtype)
+        half = self.n // 2
+
+        if self.n % 2:  # rebuild the dropped half from the conjugates of the kept one
+            full = np.concatenate((spectrum, np.conj(spectrum[..., :0:-1])), axis=-1)
+            return self.full_plan.execute(full, dtype=dtype).real
+
+        # A real signal has real DC and Nyquist bins; like np.fft.irfft, ignore any imaginary part they were given
+        if spectrum[..., 0].imag.any() or spectrum[..., half].imag.any():
+            spectrum = spectrum.copy()
+            spectrum[..., 0] = spectrum[..., 0].real
+            spectrum[..., half] = spectrum[..., half].real
+
+        mirrored = np.conj(spectrum[..., ::-1])  # conj(X[n/2 - k])
+        even = (spectrum + mirrored) / 2
+        odd = (spectrum - mirrored) / (2 * self.split_twiddles.astype(dtype, copy=False))
+        packed = self.half_plan.execute((even + 1j * odd)[..., :half], dtype=dtype)
+
+        x = np.empty(packed.shape[:-1] + (self.n,), np.finfo(dtype).dtype)
+        x[..., 0::2] = packed.real
+        x[..., 1::2] = packed.imag
         return x
 
-    w_n = np.exp(2j * np.pi / n)
-    w = 1
 
-    y_even = ifft(x[::2])
-    y_odd = ifft(x[1::2])
+def get_real_plan(n, inverse=False):
+    return _build_real_plan(int(n), bool(inverse))
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _build_real_plan(n, inverse):
+    return RealFFTPlan(n, inverse)
+
+
+# Transform x along one axis in a single batched plan execution (every other axis is treated as a batch)
+# The result is computed in dtype and written into out when it is given (out may be x itself)
+def _transform_axis(x, axis, inverse, dtype=None, out=None):
+    x = np.asarray(x)
+    dtype = _complex_dtype(dtype, out)
+    if out is not None and out.shape != x.shape:
+        raise ValueError(f"Output shape {out.shape} does not match input shape {x.shape}")
+
+    if x.shape[axis] == 0:
+        if out is None:
+            return x.astype(dtype)
+        return out
+
+    moved = np.moveaxis(x, axis, -1)  # view with the transformed axis last, no copy
+    moved_out = None if out is None else np.moveaxis(out, axis, -1)
+    result = get_plan(moved.shape[-1], inverse).execute(moved, out=moved_out, dtype=dtype)
+    return out if out is not None else np.moveaxis(result, -1, axis)
+
+
+# FFT
+# dtype=np.complex64 computes in single precision; out receives the result (and may be x, for an in-place transform)
+def fft(x, axis=-1, dtype=None, out=None):
+    return _transform_axis(x, axis, False, dtype, out)
+
 
-    y = np.zeros(n, dtype=complex)
-    for j in range(n // 2):
-        y[j] = y_even[j] + w * y_odd[j]
-        y[j + n // 2] = y_even[j] - w * y_odd[j]
-        w = w * w_n
+# Perform inverse fft for 1d input (or along one axis of an N-d input)
+def ifft(x, axis=-1, dtype=None, out=None):
+    return _transform_axis(x, axis, True, dtype, out)
 
-    return y / n
 
+# Get the fft of 2d image (or of the two given axes of an N-d array)
+# With workers > 1 the rows, then the columns, are split across a pool of worker processes
+# With out, the row pass writes into out and the column pass transforms it in place
+def fft2(image, axes=(-2, -1), workers=1, dtype=None, out=None):
+    if workers > 1:
+        result = _parallel_2d(image, ("fft", "fft"), axes, workers, dtype=_complex_dtype(dtype, out))
+        return result if out is None else _copy_into(out, result)
 
-# Get the fft of 2d image
-def fft2(image):
-    transformed_rows = np.array([fft(row) for row in image])  # apply fft to rows
-    transformed_cols = np.array([fft(col) for col in transformed_rows.T]).T  # apply fft to columns
-    return transformed_cols
+    with profile_stage("fft row pass"):
+        transformed_rows = fft(image, axis=axes[1], dtype=dtype, out=out)  # apply fft to all rows at once
+    with profile_stage("fft column pass"):
+        return fft(transformed_rows, axis=axes[0], dtype=dtype, out=transformed_rows)  # then to all columns, in place
 
 
 # Get the inverse fft of a 2d image
-def ifft2(image):
-    transformed_rows = np.array([ifft(row) for row in image])
-    transformed_cols = np.array([ifft(col) for col in transformed_rows.T]).T
-    return transformed_cols / image.size
+def ifft2(image, axes=(-2, -1), workers=1, dtype=None, out=None):
+    if workers > 1:
+        result = _parallel_2d(image, ("ifft", "ifft"), axes, workers, dtype=_complex_dtype(dtype, out))
+        return result if out is None else _copy_into(out, result)
+
+    with profile_stage("ifft row pass"):
+        transformed_rows = ifft(image, axis=axes[1], dtype=dtype, out=out)
+    with profile_stage("ifft column pass"):
+        return ifft(transformed_rows, axis=axes[0], dtype=dtype, out=transformed_rows)
+
+
+def _copy_into(out, result):
+    out[...] = result
+    return out
+
+
+# Weight of each column of a real-input spectrum of a length-n signal: columns whose conjugate mirror was
+# dropped count twice, the DC column (and the Nyquist column for even n) only once
+def hermitian_weights(n):
+    weights = np.full(n // 2 + 1, 2)
+    weights[0] = 1
+    if n % 2 == 0:
+        weights[-1] = 1
+    return weights
+
+
+# FFT of a real 1d input (or along one axis of an N-d input), keeping only the n/2 + 1 non-redundant values
+# dtype is the complex dtype of the spectrum (np.complex64 for single precision)
+def rfft(x, axis=-1, dtype=None):
+    x = np.asarray(x)
+    dtype = _complex_dtype(dtype)
+    n = x.shape[axis]
+    if n < 2:
+        return x.astype(dtype)
+
+    moved = np.moveaxis(x, axis, -1)
+    return np.moveaxis(get_real_plan(n).execute(moved, dtype), -1, axis)
+
+
+# Inverse of rfft: real signal of length n (default 2 * (m - 1)) from the m non-redundant spectrum values
+def irfft(x, n=None, axis=-1, dtype=None):
+    x = np.asarray(x)
+    dtype = _complex_dtype(dtype)
+    if n is None:
+        n = 2 * (x.shape[axis] - 1)
+    if n < 2:
+        return np.real(x).astype(np.finfo(dtype).dtype)
+
+    # Crop or zero-pad the spectrum to the n/2 + 1 values the plan expects
+    moved = np.moveaxis(x, axis, -1)
+    m = n // 2 + 1
+    if moved.shape[-1] >= m:
+        moved = moved[..., :m]
+    else:
+        moved = np.concatenate((moved, np.zeros(moved.shape[:-1] + (m - moved.shape[-1],))), axis=-1)
+
+    return np.moveaxis(get_real_plan(n, inverse=True).execute_inverse(moved, dtype), -1, axis)
+
+
+# Get the fft of a real 2d image, keeping only the non-redundant half of the last axis
+def rfft2(image, axes=(-2, -1), workers=1, dtype=None):
+    dtype = _complex_dtype(dtype)
+    if workers > 1:
+        return _parallel_2d(image, ("rfft", "fft"), axes, workers, dtype=dtype)
+
+    with profile_stage("rfft row pass"):
+        transformed_rows = rfft(image, axis=axes[1], dtype=dtype)  # real rows -> half spectrum
+    with profile_stage("fft column pass"):
+        return fft(transformed_rows, axis=axes[0], out=transformed_rows)  # columns are complex, transform in place
+
+
+# Get the real 2d image back from the half spectrum produced by rfft2
+# s is the shape of the image along axes (needed to tell odd from even widths)
+def irfft2(spectrum, s=None, axes=(-2, -1), workers=1, dtype=None):
+    dtype = _complex_dtype(dtype)
+    n = None if s is None else s[1]
+    if workers > 1:
+        return _parallel_2d(spectrum, ("ifft", "irfft"), axes, workers, n, dtype)
+
+    with profile_stage("ifft column pass"):
+        transformed_cols = ifft(spectrum, axis=axes[0], dtype=dtype)
+    with profile_stage("irfft row pass"):
+        return irfft(transformed_cols, n=n, axis=axes[1], dtype=dtype)
+
+
+# Run one pass ("fft", "ifft", "rfft" or "irfft", with output length n for "irfft") of a 2d transform on a block
+def _apply_pass(kind, block, axis, n=None, dtype=None):
+    if kind == "fft":
+        return fft(block, axis=axis, dtype=dtype)
+    if kind == "ifft":
+        return ifft(block, axis=axis, dtype=dtype)
+    if kind == "rfft":
+        return rfft(block, axis=axis, dtype=dtype)
+    if kind == "irfft":
+        return irfft(block, n=n, axis=axis, dtype=dtype)
+    raise ValueError(f"Unknown transform pass {kind!r}")
+
+
+# Worker processes shared by the parallel transforms, created on first use, and how many there are
+_process_pool = None
+_process_pool_workers = 0
+
+
+# Workers are started by a fork server (or spawned where there is none), never forked from this process directly:
+# a fork copies only the calling thread, so forking while another thread (such as the batch image loader) holds a
+# lock could leave the worker deadlocked on it
+def _get_process_pool(workers):
+    global _process_pool, _process_pool_workers
+    if _process_pool is None or _process_pool_workers != workers:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+        _process_pool_workers = workers
+    return _process_pool
+
+
+# Allocate an array in a new shared memory block, which worker processes can attach to by name
+def _shared_empty(shape, dtype):
+    dtype = np.dtype(dtype)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+# One pass of a parallel 2d transform, run in a worker process: transform source[index] along axis
+# (index selects this worker's block of rows or columns) and write the result to the same block of destination
+# source and destination are (shared memory name, shape, dtype) and may be the same array
+def _parallel_pass_worker(kind, source, destination, axis, index, n, dtype):
+    source_memory = shared_memory.SharedMemory(name=source[0])
+    destination_memory = shared_memory.SharedMemory(name=destination[0])
+    try:
+        source_array = np.ndarray(source[1], dtype=source[2], buffer=source_memory.buf)
+        destination_array = np.ndarray(destination[1], dtype=destination[2], buffer=destination_memory.buf)
+
+        destination_array[index] = _apply_pass(kind, source_array[index], axis, n, dtype)
+
+        del source_array, destination_array  # views of the shared buffers must be gone before closing them
+    finally:
+        source_memory.close()
+        destination_memory.close()
+
+
+# 2d transform with the row pass and then the column pass each split across worker processes
+# kinds names the transform of the row pass (along axes[1]) and of the column pass (along axes[0]); the image and
+# every intermediate result live in shared memory, so only names and slices are sent to the workers
+def _parallel_2d(image, kinds, axes, workers, n=None, dtype=np.complex128):
+    image = np.asarray(image)
+    column_axis, row_axis = (axis % image.ndim for axis in axes)  # rows run along axes[1], columns along axes[0]
+    dtype = np.dtype(dtype)
+    real_dtype = np.finfo(dtype).dtype  # dtype of real input (rfft) and output (irfft)
+    pool = _get_process_pool(workers)
+
+    # (transform, axis transformed, axis split across workers) of each pass: the row pass comes first, except for
+    # inverse real transforms, whose real output must come from the last pass
+    if kinds[1] == "irfft":
+        passes = [(kinds[0], column_axis, row_axis), (kinds[1], row_axis, column_axis)]
+    else:
+        passes = [(kinds[0], row_axis, column_axis), (kinds[1], column_axis, row_axis)]
+
+    blocks = []  # shared memory blocks to release at the end
+    current = destination = None
+    try:
+        memory, current = _shared_empty(image.shape, real_dtype if kinds[0] == "rfft" else dtype)
+        blocks.append(memory)
+        current[...] = image
+        current_spec = (memory.name, current.shape, current.dtype.str)
+
+        for kind, axis, split_axis in passes:
+            # Complex transforms are done in place, real ones change the shape and dtype and need a new shared array
+            if kind in ("fft", "ifft"):
+                destination, destination_spec = current, current_spec
+            else:
+                shape = list(current.shape)
+                if kind == "rfft":
+                    shape[axis] = shape[axis] // 2 + 1
+                else:
+                    shape[axis] = 2 * (shape[axis] - 1) if n is None else n
+                memory, destination = _shared_empty(tuple(shape), dtype if kind == "rfft" else real_dtype)
+                blocks.append(memory)
+                destination_spec = (memory.name, destination.shape, destination.dtype.str)
+
+            # Split the other axis into one contiguous block of rows (or columns) per worker
+            with profile_stage(f"{kind} {'row' if axis == row_axis else 'column'} pass"):
+                bounds = np.linspace(0, current.shape[split_axis], workers + 1).astype(int)
+                futures = []
+                for start, stop in zip(bounds[:-1], bounds[1:]):
+                    if start == stop:
+                        continue
+                    index = [slice(None)] * image.ndim
+                    index[split_axis] = slice(start, stop)
+                    futures.append(pool.submit(_parallel_pass_worker, kind, current_spec, destination_spec, axis,
+                                               tuple(index), n, dtype))
+                for future in futures:
+                    future.result()  # re-raises any error from the worker
+
+            current, current_spec = destination, destination_spec
+
+        return current.copy()  # the shared blocks are released below
+    finally:
+        del current, destination  # views of the shared buffers must be gone before closing them
+        for memory in blocks:
+            memory.close()
+            memory.unlink()
+
+
+# Memory (in bytes) the out-of-core transforms may use for one block of rows or columns
+OUT_OF_CORE_BUDGET = 256 * 2 ** 20
+
+# Bytes needed per complex value of a block in flight: the block, its result and the plan's temporaries
+_BLOCK_BYTES_PER_VALUE = 6 * 16
+
+
+# Slices of 0..count in blocks of lines (rows or columns) of line_length values that fit in ram_budget
+def _line_blocks(count, line_length, ram_budget):
+    lines = max(1, ram_budget // (max(line_length, 1) * _BLOCK_BYTES_PER_VALUE))
+    return [slice(start, min(start + lines, count)) for start in range(0, count, lines)]
+
+
+# Run one pass of a 2d transform block by block, from source to destination (both 2d, usually memory-mapped)
+# Only one block of rows (axis 1) or columns (axis 0) is read into memory at a time
+def _blocked_pass(kind, source, destination, axis, ram_budget, n=None):
+    split_axis = 1 - axis
+    line_length = max(source.shape[axis], destination.shape[axis])
+
+    with profile_stage(f"{kind} {'row' if axis == 1 else 'column'} pass"):
+        for block in _line_blocks(source.shape[split_axis], line_length, ram_budget):
+            index = (block, slice(None)) if split_axis == 0 else (slice(None), block)
+            destination[index] = _apply_pass(kind, np.asarray(source[index]), axis, n)
+
+        if isinstance(destination, np.memmap):
+            destination.flush()
+
+
+# Create a memory-mapped .npy file (readable later with np.load(path, mmap_mode="r"))
+def _open_output(path, shape, dtype):
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+
+# Out-of-core fft2 (or ifft2) of a 2d array, usually an np.memmap, written to a memory-mapped complex .npy file
+# at output_path; rows, then columns, are transformed in blocks that fit in ram_budget bytes
+def fft2_out_of_core(source, output_path, ram_budget=OUT_OF_CORE_BUDGET, inverse=False):
+    kind = "ifft" if inverse else "fft"
+    output = _open_output(output_path, source.shape, np.complex128)
+    _blocked_pass(kind, source, output, 1, ram_budget)  # row pass
+    _blocked_pass(kind, output, output, 0, ram_budget)  # column pass, in place
+    return output
+
+
+# Out-of-core rfft2 of a real 2d array, written to a memory-mapped complex .npy file at output_path
+def rfft2_out_of_core(source, output_path, ram_budget=OUT_OF_CORE_BUDGET):
+    output = _open_output(output_path, (source.shape[0], source.shape[1] // 2 + 1), np.complex128)
+    _blocked_pass("rfft", source, output, 1, ram_budget)
+    _blocked_pass("fft", output, output, 0, ram_budget)
+    return output
+
+
+# Out-of-core irfft2 of a half spectrum, written to a memory-mapped real .npy file at output_path
+# shape is the (height, width) of the image; the column pass goes through a scratch file next to the output
+def irfft2_out_of_core(spectrum, output_path, shape, ram_budget=OUT_OF_CORE_BUDGET):
+    scratch_path = output_path + ".partial.npy"
+    scratch = _open_output(scratch_path, spectrum.shape, np.complex128)
+    try:
+        _blocked_pass("ifft", spectrum, scratch, 0, ram_budget)
+        output = _open_output(output_path, shape, np.float64)
+        _blocked_pass("irfft", scratch, output, 1, ram_budget, n=shape[1])
+    finally:
+        del scratch
+        os.remove(scratch_path)
+    return output
+
+
+# Colour images (H, W, C) are transformed as one stack of channels (C, H, W), so that a single batched call with
+# shared plans covers every channel; grayscale images become a stack of one channel (both are views, not copies)
+def to_channel_stack(image):
+    return np.moveaxis(image, -1, 0) if image.ndim == 3 else image[np.newaxis]
+
+
+# Inverse of to_channel_stack, for an image with ndim dimensions
+def from_channel_stack(stack, ndim):
+    return np.moveaxis(stack, 0, -1) if ndim == 3 else stack[0]
+
+
+# Magnitude of a (possibly colour) result image, clipped to the [0, 1] range colour images are displayed in
+def displayable(image):
+    magnitude = np.abs(image)
+    return np.clip(magnitude, 0, 1) if magnitude.ndim == 3 else magnitude
+
 
+# Magnitude of the 2d fft of every channel, averaged over the channels of colour images
+@profiled("spectrum")
+def spectrum_magnitude(image, workers=1, dtype=None):
+    magnitude = np.abs(fft2(to_channel_stack(image), workers=workers, dtype=dtype))
+    return magnitude.mean(axis=0)
+
+
+def fast_mode(padded_image, workers=1, dtype=None):
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
 
-def fast_mode(padded_image):
     # One by two subplot of original image
     plt.subplot(1, 3, 1)
     plt.title("Original")
@@ -111,89 +878,629 @@ def fast_mode(padded_image):
     plt.subplot(1, 3, 2)
     plt.title("fft2d")
 
-    # My fft on original image
-    fft2d_result = fft2(padded_image)
-    magnitude = np.abs(fft2d_result)
+    # My fft on original image (colour channels are transformed together and their magnitudes averaged)
+    magnitude = spectrum_magnitude(padded_image, workers, dtype)
     plt.imshow(magnitude, norm=LogNorm(), cmap="gray")
     plt.axis("off")
 
     # np.fft.fft2
     plt.subplot(1, 3, 3)
     plt.title("np.fft.fft2")
-    np_result = np.fft.fft2(padded_image)
+    np_result = np.fft.fft2(padded_image, axes=(0, 1))
     np_magnitude = np.abs(np_result)
+    if np_magnitude.ndim == 3:
+        np_magnitude = np_magnitude.mean(axis=-1)
     plt.imshow(np_magnitude, norm=LogNorm(), cmap="gray")
     plt.axis("off")
 
     plt.show()
 
 
-def denoise(padded_image, frequency_cutoff=390):
-    # Take fft of image
-    fft_result = fft2(padded_image)
-    fft_result = np.fft.fftshift(fft_result)  # shift result to center
+# Distance of every coefficient of an rfft2 spectrum of an image of the given shape from the zero frequency
+# (only for the given slice of rows, when the spectrum is processed in blocks)
+# Frequencies are in cycles per pixel (0 to 0.5 along each axis), so they do not depend on how far the image was
+# zero-padded: padding only samples the same spectrum more finely
+def frequency_radius(shape, rows=slice(None)):
+    height, width = shape
+    row_frequencies = np.fft.fftfreq(height)[rows]  # signed frequency of every row: 0, 1/height, ..., -1/height
+    column_frequencies = np.arange(width // 2 + 1) / width  # non-negative frequencies kept by rfft2
+    return np.sqrt(row_frequencies[:, None] ** 2 + column_frequencies[None, :] ** 2)
+
+
+# Frequency-domain filters: transfer functions evaluated on the rfft2 half spectrum of an image of the given shape
+# (for the given slice of rows, like frequency_radius), which multiply that spectrum directly
+# Cutoffs are frequencies in cycles per pixel, like frequency_radius
+
+# Ideal low-pass: keep only the frequencies within cutoff (the sharp edge makes the image ring around edges)
+def ideal_lowpass(shape, cutoff, rows=slice(None)):
+    return (frequency_radius(shape, rows) <= cutoff).astype(float)
 
-    width, height = padded_image.shape  # get center point of 2d fourier transform
-    center_x, center_y = width // 2, height // 2
 
-    # Create mask by selecting frequencies below frequency cutoff
-    y, x = np.ogrid[:width, :height]
-    distance_from_center = np.sqrt((x - center_x) ** 2 + (y - center_y) ** 2)
-    mask = distance_from_center <= frequency_cutoff
+# Gaussian low-pass with a standard deviation of sigma cycles per pixel, smooth so it does not ring
+def gaussian_lowpass(shape, sigma, rows=slice(None)):
+    radius = frequency_radius(shape, rows)
+    return np.exp(-radius ** 2 / (2 * sigma ** 2))
+
+
+# Butterworth low-pass: flat up to about cutoff, then rolling off faster the higher the order
+def butterworth_lowpass(shape, cutoff, order=2, rows=slice(None)):
+    radius = frequency_radius(shape, rows)
+    return 1 / (1 + (radius / cutoff) ** (2 * order))
 
-    # Count the number of non-zero coefficients in the mask
-    non_zero_coefficients = np.sum(mask)  # number of true elements in mask
-    total_coefficients = mask.size  # total number of elements (true or false) in mask
-    fraction_used = non_zero_coefficients / total_coefficients
 
-    # Print the number of non-zero coefficients and their fraction
-    print(f"Non-zero coefficients used: {non_zero_coefficients}")
-    print(f"Fraction of total coefficients used: {fraction_used}")
+# Butterworth band-pass keeping the frequencies between low and high
+def band_pass(shape, low, high, order=2, rows=slice(None)):
+    transfer = butterworth_lowpass(shape, high, order, rows)
+    if low > 0:
+        transfer *= 1 - butterworth_lowpass(shape, low, order, rows)
+    return transfer
 
-    # Apply mask to denoise
-    denoised_fft = fft_result * mask
-    denoised_fft = np.fft.fftshift(denoised_fft)  # shift result to center
 
-    # Take inverse fft
-    denoised_image = ifft2(denoised_fft)
+# Filters by name: name -> function of (shape, *parameters, rows=slice(None))
+FILTERS = {
+    "ideal": ideal_lowpass,
+    "gaussian": gaussian_lowpass,
+    "butterworth": butterworth_lowpass,
+    "band": band_pass,
+}
+
+# Number of transfer functions and kernel spectra kept for reuse (one per filter and image size in a batch)
+FILTER_CACHE_SIZE = 32
+
+
+# Transfer function of a named filter for a whole spectrum, cached so same-sized images share it (read-only)
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def transfer_function(name, shape, *parameters):
+    transfer = FILTERS[name](shape, *parameters)
+    transfer.setflags(write=False)
+    return transfer
+
+
+# Filter a (possibly colour) image with a named filter, e.g. filter_image(image, "gaussian", 0.05)
+def filter_image(image, name, *parameters, workers=1, dtype=None):
+    height, width = image.shape[:2]
+    spectrum = rfft2(to_channel_stack(image), workers=workers, dtype=dtype)
+    spectrum *= transfer_function(name, (height, width), *parameters)  # the same filter for every channel
+    filtered = irfft2(spectrum, s=(height, width), workers=workers, dtype=spectrum.dtype)
+    return from_channel_stack(filtered, image.ndim)
+
+
+# rfft2 of a spatial kernel zero-padded to shape, with its centre moved to the origin so the convolution is not
+# shifted; cached by (kernel, shape), so every image of a batch pays for the kernel transform only once
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def _kernel_spectrum(kernel_bytes, kernel_shape, shape, dtype):
+    kernel = np.frombuffer(kernel_bytes).reshape(kernel_shape)
+    padded = np.zeros(shape)
+    padded[:kernel_shape[0], :kernel_shape[1]] = kernel
+    padded = np.roll(padded, (-((kernel_shape[0] - 1) // 2), -((kernel_shape[1] - 1) // 2)), axis=(0, 1))
+
+    spectrum = rfft2(padded, dtype=dtype)
+    spectrum.setflags(write=False)
+    return spectrum
+
+
+def kernel_spectrum(kernel, shape, dtype=None):
+    kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+    return _kernel_spectrum(kernel.tobytes(), kernel.shape, tuple(shape), _complex_dtype(dtype))
+
+
+# Convolve every channel of a (possibly colour) image with a 2d spatial kernel by multiplying their spectra
+# mode "same" zero-pads the image (to fast transform sizes) and returns the image-sized centre of the linear
+# convolution; mode "wrap" convolves circularly, without padding
+# Cheaper than spatial convolution once the kernel has more than a few dozen values
+def convolve(image, kernel, mode="same", workers=1, dtype=None):
+    kernel = np.asarray(kernel)
+    height, width = image.shape[:2]
+    if kernel.ndim != 2:
+        raise ValueError(f"Kernel must be 2d, got shape {kernel.shape}")
+
+    if mode == "same":
+        shape = (next_fast_len(height + kernel.shape[0] - 1), next_fast_len(width + kernel.shape[1] - 1))
+    elif mode == "wrap":
+        if kernel.shape[0] > height or kernel.shape[1] > width:
+            raise ValueError(f"Kernel of shape {kernel.shape} is larger than the image")
+        shape = (height, width)
+    else:
+        raise ValueError(f"Unknown convolution mode {mode!r}")
+
+    channels = to_channel_stack(image)
+    padded = np.zeros((len(channels),) + shape, dtype=np.finfo(_complex_dtype(dtype)).dtype)
+    padded[:, :height, :width] = channels
+
+    spectrum = rfft2(padded, workers=workers, dtype=dtype)
+    spectrum *= kernel_spectrum(kernel, shape, dtype)
+    convolved = irfft2(spectrum, s=shape, workers=workers, dtype=spectrum.dtype)[:, :height, :width]
+    return from_channel_stack(convolved, image.ndim)
+
+
+# Normalised 2d Gaussian kernel with standard deviation sigma pixels, out to radius pixels (3 sigma by default)
+def gaussian_kernel(sigma, radius=None):
+    if radius is None:
+        radius = int(np.ceil(3 * sigma))
+    offsets = np.arange(-radius, radius + 1)
+    profile = np.exp(-offsets ** 2 / (2 * sigma ** 2))
+    kernel = np.outer(profile, profile)
+    return kernel / kernel.sum()
+
+
+# Filters whose transfer function is a hard 0/1 mask, the only ones for which a count of kept coefficients means
+# anything (the smooth filters weaken every coefficient without zeroing any of them)
+HARD_MASK_FILTERS = ("ideal",)
+
+
+# What a filter mask keeps of a spectrum, or of a block of its rows (stacked channels share the mask), counting
+# dropped conjugates through weights: (non-zero coefficients of the mask, or None for a smooth filter, energy of the
+# spectrum and energy left after the mask, both 0 for a hard mask, which does not need them)
+def _mask_usage(filter_name, spectrum, mask, weights):
+    if filter_name in HARD_MASK_FILTERS:
+        return np.sum((mask != 0) * weights) * (spectrum.size // mask.size), 0.0, 0.0
+
+    power = np.abs(spectrum) ** 2 * weights
+    return None, float(np.sum(power)), float(np.sum(power * mask ** 2))
+
+
+# De-noise by keeping only the frequencies within frequency_cutoff (cycles per pixel) of the zero frequency
+# filter_name picks the low-pass filter from FILTERS: "ideal" (a hard cutoff), or "gaussian" or "butterworth",
+# which roll off smoothly around frequency_cutoff instead of ringing
+# original_shape crops the padding back off the de-noised image
+# With ram_budget (bytes), the transforms and the masking run out of core, on memory-mapped files in scratch_dir
+# (a temporary directory by default), so only blocks of rows or columns are held in memory at a time
+# dtype=np.complex64 computes the in-memory transforms in single precision, halving the memory of the spectrum
+# Returns (de-noised image, number of non-zero coefficients used, fraction of all coefficients used); the smooth
+# filters keep no coefficient count, so they return None and the fraction of the spectrum's energy kept instead
+@profiled("denoise")
+def denoise_image(padded_image, frequency_cutoff=0.47, original_shape=None, workers=1, ram_budget=None,
+                  scratch_dir=None, dtype=None, filter_name="ideal"):
+    height, width = padded_image.shape[:2]
+    weights = hermitian_weights(width)  # kept coefficients also stand for their dropped conjugates
+
+    if ram_budget is not None:
+        denoised_image, non_zero_coefficients, energy, kept_energy = _denoise_out_of_core(
+            padded_image, frequency_cutoff, weights, original_shape, ram_budget, scratch_dir, filter_name)
+    else:
+        # Take fft of image (the image is real, so only half of the spectrum is needed)
+        # Every colour channel is transformed in the same batched call
+        channels = to_channel_stack(padded_image)
+        fft_result = rfft2(channels, workers=workers, dtype=dtype)
+
+        # Create mask from the distance of every kept coefficient from the zero frequency (for the ideal filter,
+        # 1 for the frequencies below the frequency cutoff and 0 elsewhere)
+        with profile_stage("mask"):
+            mask = transfer_function(filter_name, (height, width), frequency_cutoff)
+
+            # Count the number of non-zero coefficients in the mask, counting the dropped conjugate coefficients
+            # (or, for a smooth filter, the energy it keeps)
+            non_zero_coefficients, energy, kept_energy = _mask_usage(filter_name, fft_result, mask, weights)
+
+            # Apply mask to denoise (the same mask to every channel), in place
+            fft_result *= mask
+
+        # Take inverse fft
+        with profile_stage("inverse"):
+            denoised_image = irfft2(fft_result, s=(height, width), workers=workers, dtype=dtype)
+        denoised_image = from_channel_stack(denoised_image, padded_image.ndim)
+        if original_shape is not None:
+            denoised_image = denoised_image[:original_shape[0], :original_shape[1]]
+
+    if non_zero_coefficients is not None:
+        total_coefficients = padded_image.size  # total number of elements (true or false) in the full mask
+        fraction_used = non_zero_coefficients / total_coefficients
+    else:
+        fraction_used = kept_energy / energy if energy else 1.0
+
+    return denoised_image, non_zero_coefficients, fraction_used
+
+
+# Out-of-core version of denoise_image: the spectrum is masked in place one block of rows at a time
+# Returns (de-noised image, number of non-zero coefficients used, spectrum energy, energy kept), see _mask_usage
+def _denoise_out_of_core(padded_image, frequency_cutoff, weights, original_shape, ram_budget, scratch_dir,
+                         filter_name="ideal"):
+    if padded_image.ndim != 2:
+        raise ValueError("Out-of-core de-noising only supports grayscale images")
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        fft_result = rfft2_out_of_core(padded_image, os.path.join(scratch, "spectrum.npy"), ram_budget)
+
+        non_zero_coefficients = 0 if filter_name in HARD_MASK_FILTERS else None
+        energy = kept_energy = 0.0
+        with profile_stage("mask"):
+            for rows in _line_blocks(fft_result.shape[0], fft_result.shape[1], ram_budget):
+                mask = FILTERS[filter_name](padded_image.shape, frequency_cutoff, rows=rows)
+                block_coefficients, block_energy, block_kept_energy = _mask_usage(filter_name, fft_result[rows], mask,
+                                                                                  weights)
+                if non_zero_coefficients is not None:
+                    non_zero_coefficients += int(block_coefficients)
+                energy += block_energy
+                kept_energy += block_kept_energy
+                fft_result[rows] *= mask
+
+        with profile_stage("inverse"):
+            denoised_image = irfft2_out_of_core(fft_result, os.path.join(scratch, "denoised.npy"),
+                                                padded_image.shape, ram_budget)
+        if original_shape is not None:
+            denoised_image = denoised_image[:original_shape[0], :original_shape[1]]
+        denoised_image = np.array(denoised_image)  # the scratch files are removed on return
+
+        del fft_result
+    return denoised_image, non_zero_coefficients, energy, kept_energy
+
+
+# De-noise and plot the result next to the original image
+def denoise(padded_image, frequency_cutoff=0.47, original_shape=None, workers=1, ram_budget=None, dtype=None,
+            filter_name="ideal"):
+    import matplotlib.pyplot as plt
+
+    denoised_image, non_zero_coefficients, fraction_used = denoise_image(padded_image, frequency_cutoff,
+                                                                         original_shape, workers, ram_budget,
+                                                                         dtype=dtype, filter_name=filter_name)
+
+    # Print the number of non-zero coefficients and their fraction (the energy kept, for a smooth filter)
+    if non_zero_coefficients is not None:
+        print(f"Non-zero coefficients used: {non_zero_coefficients}")
+        print(f"Fraction of total coefficients used: {fraction_used}")
+    else:
+        print(f"Fraction of spectrum energy kept: {fraction_used}")
 
     # Plot the original image
     plt.subplot(1, 2, 1)
     plt.title("Original Image")
-    plt.imshow(padded_image, cmap="gray")
+    if original_shape is not None:
+        plt.imshow(padded_image[:original_shape[0], :original_shape[1]], cmap="gray")
+    else:
+        plt.imshow(padded_image, cmap="gray")
     plt.axis("off")
 
     # Plot the denoised image
     plt.subplot(1, 2, 2)
-    plt.title(f"De-noised Image {frequency_cutoff}")
-    magnitude = np.abs(denoised_image)
-    plt.imshow(magnitude, cmap="gray")
+    plt.title(f"De-noised Image ({filter_name} {frequency_cutoff:g})")
+    plt.imshow(displayable(denoised_image), cmap="gray")
     plt.axis("off")
 
     plt.show()
 
 
-def compress(padded_image):
-    # Take fft of image to compress it
-    fft2_result = fft2(padded_image)
-    magnitude = np.abs(fft2_result)
+# De-noise with every cutoff in cutoffs, writing each de-noised image to output_dir as soon as it is ready
+# The spectrum and the radius map are computed once; coefficients are ranked by radius once, so each (larger)
+# cutoff only adds the coefficients between the previous cutoff and itself
+# Each result is also written to output_dir/sweep.jsonl with its coefficient count and fraction
+@profiled("denoise sweep")
+def denoise_sweep(padded_image, cutoffs, output_dir, original_shape=None, workers=1, dtype=None):
+    height, width = padded_image.shape[:2]
+    fft_result = rfft2(to_channel_stack(padded_image), workers=workers, dtype=dtype)  # every colour channel in one call
+    channels = len(fft_result)
+    flat_fft = fft_result.reshape(channels, -1)  # one row of coefficients per channel
+
+    # Rank coefficients by distance from the zero frequency (the same ranking for every channel)
+    radius = frequency_radius((height, width)).ravel()
+    order = np.argsort(radius, kind="stable")
+    sorted_radius = radius[order]
+    weights = np.broadcast_to(hermitian_weights(width), fft_result.shape[1:]).ravel()
+
+    os.makedirs(output_dir, exist_ok=True)
+    denoised_fft = np.zeros_like(flat_fft)
+    non_zero_coefficients = 0
+    kept = 0  # coefficients order[:kept] are in denoised_fft
+
+    with open(os.path.join(output_dir, "sweep.jsonl"), "w") as log:
+        for frequency_cutoff in sorted(cutoffs):
+            # Add the coefficients with previous cutoff < radius <= frequency_cutoff
+            end = int(np.searchsorted(sorted_radius, frequency_cutoff, side="right"))
+            added = order[kept:end]
+            denoised_fft[:, added] = flat_fft[:, added]
+            non_zero_coefficients += int(np.sum(weights[added])) * channels
+            kept = end
+
+            denoised_image = irfft2(denoised_fft.reshape(fft_result.shape), s=(height, width), workers=workers,
+                                    dtype=fft_result.dtype)
+            denoised_image = from_channel_stack(denoised_image, padded_image.ndim)
+            if original_shape is not None:
+                denoised_image = denoised_image[:original_shape[0], :original_shape[1]]
+
+            path = os.path.join(output_dir, f"denoised_{frequency_cutoff:g}.png")
+            write_image(path, displayable(denoised_image), cmap="gray")
+
+            result = {
+                "cutoff": frequency_cutoff,
+                "non_zero_coefficients": non_zero_coefficients,
+                "fraction_used": non_zero_coefficients / padded_image.size,
+                "image": path,
+            }
+            log.write(json.dumps(result) + "\n")
+            log.flush()  # results are usable while the sweep is still running
+            print(f"Cutoff {frequency_cutoff:g}: {non_zero_coefficients} non-zero coefficients "
+                  f"({result['fraction_used']:.4f} of total), written to {path}")
+
+
+# Version written into (and required from) compressed image files
+COMPRESSED_FORMAT_VERSION = 1
+
+
+# Rank the coefficients of a real-input spectrum by decreasing magnitude with one sort, and find for every level
+# how many of the leading coefficients must be kept to cover that fraction of the full spectrum
+# (weights counts each kept coefficient together with its dropped conjugate, see hermitian_weights)
+# Returns (flat indices in decreasing magnitude order, number of coefficients to keep for each level)
+@profiled("threshold")
+def rank_coefficients(spectrum, levels, weights):
+    magnitude = np.abs(spectrum).ravel()
+    order = np.argsort(-magnitude, kind="stable")
+
+    covered = np.cumsum(np.broadcast_to(weights, spectrum.shape).ravel()[order])  # full coefficients covered
+    counts = [min(len(order), int(np.searchsorted(covered, level * covered[-1])) + 1) for level in levels]
+    return order, counts
+
+
+# Write the kept coefficients of a real-input spectrum (flat indices kept) to a compressed .npz file
+# Only the kept coefficients are stored: their sorted indices as deltas (which zlib packs tightly), and their
+# values as float16 real and imaginary parts scaled by the largest magnitude
+def save_compressed(path, spectrum, kept, image_shape):
+    kept = np.sort(kept)
+    values = spectrum.ravel()[kept]
+    scale = float(np.max(np.abs(values), initial=0.0)) or 1.0
+
+    np.savez_compressed(
+        path,
+        version=COMPRESSED_FORMAT_VERSION,
+        image_shape=np.array(image_shape),
+        spectrum_shape=np.array(spectrum.shape),
+        scale=scale,
+        index_deltas=np.diff(kept, prepend=0).astype(np.uint32),
+        values=(np.stack((values.real, values.imag), axis=-1) / scale).astype(np.float16),
+    )
+
+
+# Write the coefficients of a (memory-mapped) real-input spectrum at or above threshold to a compressed .npz file
+# in the format of save_compressed, reading one block of rows that fits in ram_budget at a time
+# A first pass counts the kept coefficients and finds their scale, so the .npy headers of index_deltas and values
+# can be written up front; both members are then appended to block by block (one pass each, since a zip file only
+# takes one open member at a time)
+def save_compressed_blocks(path, spectrum, threshold, image_shape, ram_budget):
+    blocks = _line_blocks(spectrum.shape[0], spectrum.shape[1], ram_budget)
+    count = 0
+    scale = 0.0
+    for rows in blocks:
+        magnitude = np.abs(spectrum[rows])
+        kept_magnitude = magnitude[magnitude >= threshold]
+        count += kept_magnitude.size
+        scale = max(scale, float(np.max(kept_magnitude, initial=0.0)))
+    scale = scale or 1.0
+
+    # Flat indices and values of the kept coefficients of every block, in increasing index order
+    def kept_blocks():
+        for rows in blocks:
+            block = np.asarray(spectrum[rows])
+            kept = np.flatnonzero(np.abs(block) >= threshold)
+            yield kept + rows.start * spectrum.shape[1], block.ravel()[kept]
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        small_arrays = {
+            "version": np.asarray(COMPRESSED_FORMAT_VERSION),
+            "image_shape": np.array(image_shape),
+            "spectrum_shape": np.array(spectrum.shape),
+            "scale": np.asarray(scale),
+        }
+        for name, array in small_arrays.items():
+            with archive.open(f"{name}.npy", "w") as member:
+                np.lib.format.write_array(member, array)
+
+        with archive.open("index_deltas.npy", "w", force_zip64=True) as member:
+            _write_npy_header(member, np.uint32, (count,))
+            previous = 0
+            for indices, _ in kept_blocks():
+                member.write(np.diff(indices, prepend=previous).astype(np.uint32).tobytes())
+                if len(indices):
+                    previous = indices[-1]
+
+        with archive.open("values.npy", "w", force_zip64=True) as member:
+            _write_npy_header(member, np.float16, (count, 2))
+            for _, values in kept_blocks():
+                member.write((np.stack((values.real, values.imag), axis=-1) / scale).astype(np.float16).tobytes())
+
+
+# Write the .npy header of a C-ordered array of the given dtype and shape, whose data is written after it
+def _write_npy_header(file, dtype, shape):
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": shape}
+    np.lib.format.write_array_header_1_0(file, header)
+
+
+# A compressed image file written by save_compressed, decoded only when its spectrum or image is asked for
+class CompressedImage:
+    def __init__(self, path):
+        self.path = path
+        self._file = np.load(path)  # arrays are only read from the file when accessed
+
+        version = int(self._file["version"])
+        if version != COMPRESSED_FORMAT_VERSION:
+            raise ValueError(f"Unsupported compressed image version {version} in {path}")
+
+        self.image_shape = tuple(int(size) for size in self._file["image_shape"])
+        self.spectrum_shape = tuple(int(size) for size in self._file["spectrum_shape"])
+
+    def __repr__(self):
+        return f"CompressedImage({self.path!r}, image_shape={self.image_shape})"
+
+    def close(self):
+        self._file.close()
+
+    # Number of coefficients stored in the file
+    def coefficient_count(self):
+        return len(self._file["index_deltas"])
+
+    # Rebuild the real-input spectrum, with every coefficient that was not kept set to 0
+    def spectrum(self):
+        indices = np.cumsum(self._file["index_deltas"], dtype=np.int64)
+        values = self._file["values"].astype(np.float64) * float(self._file["scale"])
+
+        spectrum = np.zeros(int(np.prod(self.spectrum_shape)), dtype=complex)
+        spectrum[indices] = values[:, 0] + 1j * values[:, 1]
+        return spectrum.reshape(self.spectrum_shape)
+
+    # Decode the image (colour spectra are stored as a stack of channels, see to_channel_stack)
+    def decode(self, workers=1):
+        image = irfft2(self.spectrum(), s=self.image_shape[:2], workers=workers)
+        return np.moveaxis(image, 0, -1) if len(self.image_shape) == 3 else image
+
+
+# Open a compressed image file written by save_compressed
+def load_compressed(path):
+    return CompressedImage(path)
+
+
+# Fractions of coefficients kept by compress
+COMPRESSION_LEVELS = [1.0, 0.8, 0.6, 0.4, 0.2, 0.001]
+
+
+# Number of log-spaced magnitude bins the out-of-core compression thresholds are chosen from
+THRESHOLD_BINS = 4096
+
+
+# Compress by keeping only the largest-magnitude fraction of the frequencies, for every compression level
+# original_shape crops the padding back off the compressed images
+# With output_dir, every compression level is also written there as a compressed image file; decode=False skips
+# the inverse transforms when only those files are wanted
+# With ram_budget (bytes), the transforms run out of core on memory-mapped files in scratch_dir (a temporary
+# directory by default), and the thresholds come from a magnitude histogram instead of a full sort
+# dtype=np.complex64 computes the in-memory transforms in single precision
+# Returns (compressed images, or None without decode, number of non-zero frequencies of each level)
+@profiled("compress")
+def compress_image(padded_image, compression_levels=COMPRESSION_LEVELS, original_shape=None, workers=1,
+                   output_dir=None, decode=True, ram_budget=None, scratch_dir=None, dtype=None):
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    weights = hermitian_weights(padded_image.shape[1])  # kept coefficients also stand for their dropped conjugates
+    if ram_budget is not None:
+        return _compress_out_of_core(padded_image, compression_levels, weights, original_shape, output_dir, decode,
+                                     ram_budget, scratch_dir)
+
+    # Take fft of image to compress it (the image is real, so only half of the spectrum is needed)
+    # Colour channels are transformed together, as a stack of channels, and share one magnitude ranking
+    if padded_image.ndim == 3:
+        fft2_result = rfft2(to_channel_stack(padded_image), workers=workers, dtype=dtype)
+    else:
+        fft2_result = rfft2(padded_image, workers=workers, dtype=dtype)
+    height, width = padded_image.shape[:2]
 
-    compression_levels = [1.0, 0.8, 0.6, 0.4, 0.2, 0.001]  # fraction of coefficients to keep
-    compressed_images = []  # store compressed images
+    compressed_images = [] if decode else None  # store compressed images
     non_zero_counts = []
 
-    for level in compression_levels:
-        threshold = np.percentile(magnitude, (1.0 - level) * 100)
-        mask = magnitude >= threshold  # get list of frequencies above magnitude threshold
-
-        compressed_fft = fft2_result * mask  # filter frequencies below magnitude threshold
-        non_zero_counts.append(np.sum(mask))
-
-        compressed_image = ifft2(compressed_fft)  # get inverse of compressed image
-        compressed_images.append(np.abs(compressed_image))  # store compressed image
+    # Rank the frequencies by magnitude once, every level keeps a prefix of that ranking
+    order, keep_counts = rank_coefficients(fft2_result, compression_levels, weights)
+    flat_fft = fft2_result.ravel()
+
+    for level, keep_count in zip(compression_levels, keep_counts):
+        kept = order[:keep_count]  # frequencies with the largest magnitudes
+        non_zero_counts.append(np.sum(np.broadcast_to(weights, fft2_result.shape).ravel()[kept]))
+
+        if output_dir is not None:
+            save = functools.partial(save_compressed, spectrum=fft2_result, kept=kept, image_shape=padded_image.shape)
+            _write_compressed_level(output_dir, level, padded_image, save)
+
+        if decode:
+            compressed_fft = np.zeros_like(flat_fft)  # filter frequencies below magnitude threshold
+            compressed_fft[kept] = flat_fft[kept]
+            compressed_fft = compressed_fft.reshape(fft2_result.shape)
+
+            # get inverse of compressed image
+            with profile_stage("inverse"):
+                compressed_image = irfft2(compressed_fft, s=(height, width), workers=workers,
+                                          dtype=fft2_result.dtype)
+            if padded_image.ndim == 3:
+                compressed_image = from_channel_stack(compressed_image, 3)
+            if original_shape is not None:
+                compressed_image = compressed_image[:original_shape[0], :original_shape[1]]
+            compressed_images.append(displayable(compressed_image))  # store compressed image
+
+    return compressed_images, non_zero_counts
+
+
+# Write one compression level to output_dir with save (a function of the file path) and report its size
+@profiled("write")
+def _write_compressed_level(output_dir, level, padded_image, save):
+    path = os.path.join(output_dir, f"compressed_{(1.0 - level) * 100:.1f}.npz")
+    save(path)
+    print(f"Compression Level: {(1.0 - level) * 100:.1f}% written to {path} "
+          f"({os.path.getsize(path)} bytes, image is {padded_image.nbytes} bytes)")
+
+
+# Magnitude threshold of every level for a (memory-mapped) real-input spectrum, read one block of rows at a time
+# Magnitudes are counted (with their Hermitian weights) into log-spaced bins below the largest one; each level's
+# threshold is the lower edge of the first bin, counting down, at which that fraction of coefficients is covered
+@profiled("threshold")
+def _magnitude_thresholds(spectrum, levels, weights, ram_budget):
+    blocks = _line_blocks(spectrum.shape[0], spectrum.shape[1], ram_budget)
+    largest = max(float(np.max(np.abs(spectrum[rows]))) for rows in blocks) or 1.0
+
+    # Bin 0 holds magnitudes below edges[0] (including zeros), bin i those in [edges[i - 1], edges[i]) and the last
+    # bin the largest magnitude itself
+    edges = np.geomspace(largest * 1e-12, largest, THRESHOLD_BINS + 1)
+    lower_edges = np.concatenate(([0.0], edges))
+    counts = np.zeros(THRESHOLD_BINS + 2)
+    for rows in blocks:
+        bins = np.searchsorted(edges, np.abs(spectrum[rows]), side="right")
+        counts += np.bincount(bins.ravel(), weights=np.broadcast_to(weights, bins.shape).ravel(),
+                              minlength=THRESHOLD_BINS + 2)
+
+    covered = np.cumsum(counts[::-1])  # coefficients in the top 1, 2, ... bins
+    thresholds = []
+    for level in levels:
+        top_bins = min(int(np.searchsorted(covered, level * covered[-1])), THRESHOLD_BINS + 1)
+        thresholds.append(lower_edges[THRESHOLD_BINS + 1 - top_bins])
+    return thresholds
+
+
+# Out-of-core version of compress_image: every level keeps the coefficients at or above its magnitude threshold
+def _compress_out_of_core(padded_image, compression_levels, weights, original_shape, output_dir, decode,
+                          ram_budget, scratch_dir):
+    if padded_image.ndim != 2:
+        raise ValueError("Out-of-core compression only supports grayscale images")
+
+    compressed_images = [] if decode else None
+    non_zero_counts = []
 
-    # Take inverse fft
-    inverse_result = ifft2(fft2_result)
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        fft2_result = rfft2_out_of_core(padded_image, os.path.join(scratch, "spectrum.npy"), ram_budget)
+        blocks = _line_blocks(fft2_result.shape[0], fft2_result.shape[1], ram_budget)
+        thresholds = _magnitude_thresholds(fft2_result, compression_levels, weights, ram_budget)
+
+        for level, threshold in zip(compression_levels, thresholds):
+            # Count the frequencies above the threshold, one block of rows at a time
+            non_zeros = 0
+            for rows in blocks:
+                non_zeros += int(np.sum((np.abs(fft2_result[rows]) >= threshold) * weights))
+            non_zero_counts.append(non_zeros)
+
+            if output_dir is not None:
+                save = functools.partial(save_compressed_blocks, spectrum=fft2_result, threshold=threshold,
+                                         image_shape=padded_image.shape, ram_budget=ram_budget)
+                _write_compressed_level(output_dir, level, padded_image, save)
+
+            if decode:
+                # Keep the frequencies above the threshold in a memory-mapped copy of the spectrum
+                compressed_fft = _open_output(os.path.join(scratch, "compressed.npy"), fft2_result.shape,
+                                              np.complex128)
+                for rows in blocks:
+                    block = np.asarray(fft2_result[rows])
+                    compressed_fft[rows] = block * (np.abs(block) >= threshold)
+
+                with profile_stage("inverse"):
+                    compressed_image = irfft2_out_of_core(compressed_fft, os.path.join(scratch, "image.npy"),
+                                                          padded_image.shape, ram_budget)
+                if original_shape is not None:
+                    compressed_image = compressed_image[:original_shape[0], :original_shape[1]]
+                compressed_images.append(np.abs(compressed_image))
+                del compressed_image, compressed_fft
+
+        del fft2_result
+    return compressed_images, non_zero_counts
+
+
+# Compress at every compression level and plot the compressed images
+def compress(padded_image, original_shape=None, workers=1, output_dir=None, ram_budget=None, dtype=None):
+    import matplotlib.pyplot as plt
+
+    compression_levels = COMPRESSION_LEVELS
+    compressed_images, non_zero_counts = compress_image(padded_image, compression_levels, original_shape, workers,
+                                                        output_dir, ram_budget=ram_budget, dtype=dtype)
 
     # 2 by 3 subplot: Display original and compressed images
     plt.figure(figsize=(12, 8))
@@ -211,23 +1518,220 @@ def compress(padded_image):
         print(f"Compression Level: {(1.0 - level) * 100:.1f}% has {non_zeros} non-zero frequencies")
 
 
-def plot():
-    # TODO
-    # Produce plots that summarize the runtime complexity of your algorithms. Your code should print in the
-    # command line the means and variances of the runtime of your algorithms versus
-    # the problem size
+# Image files picked up by batch mode when it is given a directory
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".npy")
+
+
+# Read an image file, or memory-map a 2d .npy array (for images too large to load)
+def read_image(path):
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+
+    from matplotlib import image as mpimg
+    return mpimg.imread(path)
+
+
+def write_image(path, image, **kwargs):
+    from matplotlib import image as mpimg
+    mpimg.imsave(path, image, **kwargs)
+
+
+# Paths of the images matched by a directory (every image file in it) or a glob pattern, in sorted order
+def find_images(source):
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+        return sorted(path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(glob.glob(source))
+
 
-    # From report: Create 2D arrays of random elements of various
-    # sizes (sizes must be square and powers of 2). Start from 25 and move
-    # up to 210 or up to the size that your computer can handle. Gather
-    # data for the plot by re-running the experiment at least 10 times
-    # to obtain an average runtime for each problem size and a standard
-    # deviation. On your plot you must have problem size on the x-axis
-    # and runtime in seconds on the y-axis. You can plot two lines; one
-    # for the naive method and one for the FFT. Plot your mean runtimes
-    # for each method and include error bars proportional to the standard
-    # deviation that represent a confidence interval defined by you.
-    return
+# Headless batch mode: stream every image matched by source through padding, the transform of the given mode and
+# output, writing result files to output_dir instead of plotting them
+# mode 1 writes the log-magnitude spectrum, mode 2 the de-noised image, mode 3 the compressed image files
+# The next image is read in the background while the current one is being transformed
+def run_batch(source, mode, output_dir, pad="none", frequency_cutoff=0.47, workers=1, ram_budget=None, dtype=None,
+              filter_name="ideal"):
+    paths = find_images(source)
+    if not paths:
+        print(f"ERROR   No images found for {source}")
+        return False
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        next_image = loader.submit(read_image, paths[0])
+
+        for i, path in enumerate(paths):
+            original_image = next_image.result()
+            if i + 1 < len(paths):
+                next_image = loader.submit(read_image, paths[i + 1])  # prefetch while this one is transformed
+
+            name = os.path.splitext(os.path.basename(path))[0]
+            padded_image = pad_image(original_image, pad) if pad != "none" else original_image
+            original_shape = original_image.shape[:2]
+
+            if mode == 1:
+                magnitude = spectrum_magnitude(padded_image, workers, dtype)
+                output_path = os.path.join(output_dir, f"{name}_fft2.png")
+                write_image(output_path, np.log1p(magnitude), cmap="gray")
+            elif mode == 2:
+                denoised_image, non_zero_coefficients, fraction_used = denoise_image(padded_image, frequency_cutoff,
+                                                                                     original_shape, workers,
+                                                                                     ram_budget, dtype=dtype,
+                                                                                     filter_name=filter_name)
+                output_path = os.path.join(output_dir, f"{name}_denoised.png")
+                write_image(output_path, displayable(denoised_image), cmap="gray")
+            elif mode == 3:
+                output_path = os.path.join(output_dir, name)
+                compress_image(padded_image, original_shape=original_shape, workers=workers,
+                               output_dir=output_path, decode=False, ram_budget=ram_budget, dtype=dtype)
+
+            print(f"{path} -> {output_path}")
+
+    return True
+
+
+# Methods timed by plot: name -> function of a 2d array
+BENCHMARK_METHODS = {
+    "dft_naive": dft2_naive,
+    "fft": fft,  # 1d fft of every row
+    "fft2": fft2,
+    "np.fft.fft2": np.fft.fft2,
+}
+
+
+# Time every benchmark method on square random arrays of sizes 2^5 .. 2^max_power, repeats times each
+# dft_naive is only run up to 2^naive_max_power, since it is O(N^2) per row
+def run_benchmarks(max_power=10, repeats=10, naive_max_power=10, seed=0):
+    rng = np.random.default_rng(seed)
+    results = {name: [] for name in BENCHMARK_METHODS}
+
+    for power in range(5, max_power + 1):
+        size = 2 ** power
+        array = rng.random((size, size))
+
+        for name, method in BENCHMARK_METHODS.items():
+            if name == "dft_naive" and power > naive_max_power:
+                continue
+
+            method(array)  # warm-up run, so plan creation is not timed
+
+            runtimes = []
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                method(array)
+                runtimes.append(time.perf_counter() - start_time)
+
+            results[name].append({
+                "size": size,
+                "mean": float(np.mean(runtimes)),
+                "variance": float(np.var(runtimes, ddof=1)) if repeats > 1 else 0.0,
+                "runs": runtimes,
+            })
+
+    return results
+
+
+# Sizes checked against numpy: radix-2, mixed-radix and Bluestein plans, even and odd real transforms
+ACCURACY_SIZES = (16, 60, 97, 100, 1024, 2018)
+
+
+# Compare fft, ifft, rfft and irfft with numpy on random input, returning a message for every size and transform
+# whose largest error exceeds tolerance
+# The irfft input is random complex, so not Hermitian: its DC and Nyquist bins have imaginary parts numpy ignores
+def check_accuracy(sizes=ACCURACY_SIZES, tolerance=1e-8, seed=0):
+    rng = np.random.default_rng(seed)
+    failures = []
+    for n in sizes:
+        signal = rng.standard_normal((3, n))
+        spectrum = rng.standard_normal((3, n // 2 + 1)) + 1j * rng.standard_normal((3, n // 2 + 1))
+        complex_signal = signal + 1j * rng.standard_normal((3, n))
+
+        pairs = {
+            "fft": (fft(complex_signal), np.fft.fft(complex_signal)),
+            "ifft": (ifft(complex_signal), np.fft.ifft(complex_signal)),
+            "rfft": (rfft(signal), np.fft.rfft(signal)),
+            "irfft": (irfft(spectrum, n), np.fft.irfft(spectrum, n)),
+        }
+        for name, (result, expected) in pairs.items():
+            error = float(np.max(np.abs(result - expected)))
+            if error > tolerance:
+                failures.append(f"{name} of size {n} differs from numpy by {error:.3e}")
+    return failures
+
+
+# Compare results against a baseline (same format), returning a message for every method and size
+# whose mean runtime grew by more than the threshold fraction
+def find_regressions(results, baseline, threshold=0.25):
+    regressions = []
+    for name, entries in results.items():
+        baseline_means = {entry["size"]: entry["mean"] for entry in baseline.get(name, [])}
+        for entry in entries:
+            baseline_mean = baseline_means.get(entry["size"])
+            if baseline_mean is None or baseline_mean <= 0:
+                continue  # nothing to compare against
+
+            ratio = entry["mean"] / baseline_mean
+            if ratio > 1 + threshold:
+                regressions.append(f"{name} at {entry['size']}x{entry['size']}: {entry['mean']:.6f} s vs baseline "
+                                   f"{baseline_mean:.6f} s ({ratio:.2f}x)")
+    return regressions
+
+
+# Benchmark the transforms, print means and variances of their runtimes versus problem size and plot them
+# with error bars of two standard deviations (about a 95% confidence interval)
+# Results can be written to json_path, and compared against a baseline file written the same way
+# Returns False if a transform disagrees with numpy or a regression beyond threshold was found
+def plot(max_power=10, repeats=10, naive_max_power=10, json_path=None, baseline_path=None, threshold=0.25,
+         show=True):
+    failures = check_accuracy()
+    for failure in failures:
+        print(f"INACCURATE   {failure}")
+
+    results = run_benchmarks(max_power, repeats, naive_max_power)
+
+    # Print means and variances
+    print(f"{'method':<14}{'size':>8}{'mean (s)':>16}{'variance (s^2)':>18}")
+    for name, entries in results.items():
+        for entry in entries:
+            print(f"{name:<14}{entry['size']:>8}{entry['mean']:>16.6f}{entry['variance']:>18.3e}")
+
+    if json_path is not None:
+        report = {
+            "config": {"max_power": max_power, "repeats": repeats, "naive_max_power": naive_max_power},
+            "results": results,
+        }
+        with open(json_path, "w") as file:
+            json.dump(report, file, indent=2)
+
+    passed = not failures
+    if baseline_path is not None:
+        with open(baseline_path) as file:
+            baseline = json.load(file)["results"]
+
+        regressions = find_regressions(results, baseline, threshold)
+        for regression in regressions:
+            print(f"REGRESSION   {regression}")
+        passed = passed and not regressions
+
+    if show:
+        import matplotlib.pyplot as plt
+
+        plt.figure(figsize=(8, 6))
+        for name, entries in results.items():
+            sizes = [entry["size"] for entry in entries]
+            means = [entry["mean"] for entry in entries]
+            errors = [2 * np.sqrt(entry["variance"]) for entry in entries]
+            plt.errorbar(sizes, means, yerr=errors, capsize=3, marker="o", label=name)
+
+        plt.xscale("log", base=2)
+        plt.yscale("log")
+        plt.xlabel("Problem size (N x N)")
+        plt.ylabel("Runtime (s)")
+        plt.title("Runtime versus problem size")
+        plt.legend()
+        plt.show()
+
+    return passed
 
 
 def main():
@@ -235,22 +1739,98 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--mode", type=int, choices=[1, 2, 3, 4], default=1)
     parser.add_argument("-i", "--image", type=str, default="moonlanding.png")
+    parser.add_argument("--pad", type=str, choices=["none", "pow2", "fast"], default="none")  # optional zero
+    # padding: to powers of 2, or to the nearest sizes with only small prime factors
+    parser.add_argument("-w", "--workers", type=int, default=1)  # processes the 2d transforms are split across
+    parser.add_argument("-o", "--output-dir", type=str, default=None)  # where modes 2 and 3 write their results
+    parser.add_argument("-c", "--cutoff", type=float, default=0.47)  # frequency cutoff of mode 2, in cycles per
+    # pixel (at most about 0.71), the same whatever --pad is
+    parser.add_argument("--filter", type=str, choices=["ideal", "gaussian", "butterworth"], default="ideal")  # low-pass
+    # filter of mode 2, with --cutoff as its cutoff (the standard deviation of the gaussian filter)
+    parser.add_argument("--cutoffs", type=float, nargs="+", default=None)  # mode 2 sweeps these cutoffs instead
+    # and writes every result to --output-dir
+    parser.add_argument("-b", "--batch", type=str, default=None)  # directory or glob of images to run mode 1, 2 or 3
+    # on without plotting, writing the results to --output-dir
+    parser.add_argument("--ram-budget", type=float, default=None)  # run the transforms of modes 2 and 3 out of
+    # core on memory-mapped files, using at most this many MB per block
+    parser.add_argument("--profile", type=str, default=None)  # record the time and peak allocation of every stage
+    # of modes 1-3 and write them to this JSON file
+    parser.add_argument("--precision", type=str, choices=["double", "single"], default="double")  # single runs the
+    # in-memory transforms of modes 1-3 in complex64, halving the memory of every spectrum
+
+    # Benchmark arguments (mode 4)
+    parser.add_argument("--max-power", type=int, default=10)  # largest array size is 2^max_power
+    parser.add_argument("--repeats", type=int, default=10)  # runs per method and size
+    parser.add_argument("--naive-max-power", type=int, default=10)  # largest size dft_naive is run at
+    parser.add_argument("--json", type=str, default=None)  # write results to this file
+    parser.add_argument("--baseline", type=str, default=None)  # compare against results written by --json
+    parser.add_argument("--threshold", type=float, default=0.25)  # allowed slowdown over baseline (0.25 = 25%)
+    parser.add_argument("--no-plot", action="store_true")  # only print (and save) the results
 
     args = parser.parse_args()
     mode = args.mode
     image_path = args.image
 
-    original_image = mpimg.imread(image_path)
-    padded_image = pad_image(original_image)
-
-    if mode == 1:
-        fast_mode(padded_image)
-    elif mode == 2:
-        denoise(padded_image)
-    elif mode == 3:
-        compress(padded_image)
-    elif mode == 4:
-        plot()
+    ram_budget = None if args.ram_budget is None else int(args.ram_budget * 2 ** 20)
+    dtype = np.complex64 if args.precision == "single" else np.complex128
+
+    if args.cutoffs is not None and (args.output_dir is None or args.filter != "ideal"):
+        parser.error("--cutoffs requires --output-dir and the ideal filter")
+    if args.batch is not None and (args.output_dir is None or mode == 4):
+        parser.error("--batch requires --output-dir and mode 1, 2 or 3")
+
+    if mode == 4:
+        passed = plot(args.max_power, args.repeats, args.naive_max_power, args.json, args.baseline, args.threshold,
+                      show=not args.no_plot)
+        if not passed:
+            sys.exit(1)
+        return
+
+    if args.profile is not None:
+        start_profile()
+
+    if args.batch is not None:
+        passed = run_batch(args.batch, mode, args.output_dir, args.pad, args.cutoff, args.workers, ram_budget, dtype,
+                           args.filter)
+    else:
+        passed = True
+        original_image = read_image(image_path)
+
+        # Any image size can be transformed, padding only trades a larger image for faster transform sizes
+        if args.pad != "none":
+            padded_image = pad_image(original_image, args.pad)
+        else:
+            padded_image = original_image
+        original_shape = original_image.shape[:2]
+
+        if mode == 1:
+            fast_mode(padded_image, workers=args.workers, dtype=dtype)
+        elif mode == 2:
+            if args.cutoffs is not None:
+                denoise_sweep(padded_image, args.cutoffs, args.output_dir, original_shape=original_shape,
+                              workers=args.workers, dtype=dtype)
+            else:
+                denoise(padded_image, args.cutoff, original_shape=original_shape, workers=args.workers,
+                        ram_budget=ram_budget, dtype=dtype, filter_name=args.filter)
+        elif mode == 3:
+            compress(padded_image, original_shape=original_shape, workers=args.workers, output_dir=args.output_dir,
+                     ram_budget=ram_budget, dtype=dtype)
+
+    if args.profile is not None:
+        report = stop_profile()
+        report["config"] = {
+            "mode": mode,
+            "image": args.batch if args.batch is not None else image_path,
+            "pad": args.pad,
+            "workers": args.workers,
+            "precision": args.precision,
+        }
+        with open(args.profile, "w") as file:
+            json.dump(report, file, indent=2)
+        print_profile(report)
+
+    if not passed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
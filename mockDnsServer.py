@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import collections
+import random
+import socket
+import struct
+import sys
+
+from dnsClient import (OPT_TYPE, QUERY_TYPES, RECORD_FIELDS, DNSError, MalformedResponse, encode_name, in_zone,
+                       parse_message)
+
+
+# Zone served when no zone file is given: every name under bench.test resolves (through the wildcard), so a load
+# generator can ask for as many distinct names as it likes
+DEFAULT_ZONE = """
+bench.test.             3600  SOA    ns.bench.test. admin.bench.test. 1 3600 600 86400 300
+bench.test.             3600  NS     ns.bench.test.
+bench.test.             300   MX     10 mail.bench.test.
+ns.bench.test.          3600  A      127.0.0.1
+mail.bench.test.        300   A      10.0.0.25
+www.bench.test.         300   CNAME  bench.test.
+bench.test.             300   A      10.0.0.1
+*.bench.test.           300   A      10.0.0.2
+*.bench.test.           300   AAAA   fd00::2
+"""
+
+# Response codes the server answers with
+NOERROR = 0
+FORMERR = 1
+NXDOMAIN = 3
+NOTIMP = 4
+REFUSED = 5
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-a', '--address', type=str, default='127.0.0.1')  # IPv4 address to listen on
+    parser.add_argument('-p', '--port', type=int, default=5353)  # UDP and TCP port to listen on
+    parser.add_argument('-z', '--zone', type=str, action='append', default=[])  # zone file to serve ("name [ttl]
+    # type data" lines), may be repeated; the built-in bench.test zone if none is given
+
+    # Misbehaviour, to exercise retransmission, hedging and the TCP fallback of the client
+    parser.add_argument('--delay', type=float, default=0.0)  # seconds to wait before answering
+    parser.add_argument('--jitter', type=float, default=0.0)  # up to this many seconds more, at random
+    parser.add_argument('--loss', type=float, default=0.0)  # fraction of UDP queries dropped without an answer
+    parser.add_argument('--truncate', type=float, default=0.0)  # fraction of UDP responses cut to an empty one with
+    # TC set (responses larger than the client's UDP payload size are always truncated)
+    parser.add_argument('--payload-size', type=int, default=1232)  # EDNS0 UDP payload size advertised back
+    parser.add_argument('--no-edns', action='store_true')  # answer FORMERR to queries with an EDNS0 OPT record
+    parser.add_argument('--seed', type=int, default=None)  # seed of the loss, truncation and jitter choices
+
+    return parser.parse_args()
+
+
+def validate_args(args):
+    error = ""
+    is_error = False
+
+    if not (0 <= args.port <= 65535):
+        is_error = True
+        error += f"ERROR    Invalid port number. Must be in range [0, 65535]\n"
+
+    if args.delay < 0 or args.jitter < 0:
+        is_error = True
+        error += f"ERROR    Delay and jitter must be non-negative\n"
+
+    if not (0 <= args.loss <= 1) or not (0 <= args.truncate <= 1):
+        is_error = True
+        error += f"ERROR    Loss and truncation must be fractions in range [0, 1]\n"
+
+    if not (512 <= args.payload_size <= 65535):
+        is_error = True
+        error += f"ERROR    Payload size must be in range [512, 65535]\n"
+
+    if is_error:
+        print(error)
+        sys.exit(1)
+
+
+# Names are compared in lower case without the trailing dot, the root being ''
+def normal_name(name):
+    return name.rstrip('.').lower()
+
+
+# Wire format of the RDATA of a record of record_type, from the data fields of its zone file line
+def encode_rdata(record_type, fields):
+    if record_type == QUERY_TYPES['A']:
+        return socket.inet_pton(socket.AF_INET, fields[0])
+    if record_type == QUERY_TYPES['AAAA']:
+        return socket.inet_pton(socket.AF_INET6, fields[0])
+    if record_type in (QUERY_TYPES['NS'], QUERY_TYPES['CNAME'], QUERY_TYPES['PTR']):
+        return encode_name(normal_name(fields[0]))
+    if record_type == QUERY_TYPES['MX']:
+        return int(fields[0]).to_bytes(2, 'big') + encode_name(normal_name(fields[1]))
+    if record_type == QUERY_TYPES['SOA']:
+        return (encode_name(normal_name(fields[0])) + encode_name(normal_name(fields[1])) +
+                struct.pack('>IIIII', *(int(field) for field in fields[2:7])))
+    raise ValueError(f"unsupported record type {record_type}")
+
+
+# Records of one zone, from the SOA record at its origin down to its delegations (NS records below the origin)
+class Zone:
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.records = collections.defaultdict(list)  # (name, type) -> [(TTL, RDATA)]
+        self.names = {origin}  # every name owning records, and the names between them and the origin
+
+    def add(self, name, record_type, ttl, rdata):
+        self.records[(name, record_type)].append((ttl, rdata))
+        while name != self.origin and name not in self.names:
+            self.names.add(name)
+            name = name.partition('.')[2]
+
+    # Wire format of the records of name and record_type (owned by owner, for names matched by a wildcard)
+    def rrset(self, name, record_type, owner=None):
+        prefix = encode_name(owner or name)
+        return [prefix + RECORD_FIELDS.pack(record_type, 1, ttl, len(rdata)) + rdata
+                for ttl, rdata in self.records.get((name, record_type), [])]
+
+    def soa(self):
+        return self.rrset(self.origin, QUERY_TYPES['SOA'])
+
+    # The delegation (zone cut) above or at name, if any
+    def delegation(self, name):
+        labels = name.split('.')
+        origin_length = len(self.origin.split('.')) if self.origin else 0
+        for length in range(origin_length + 1, len(labels) + 1):
+            cut = '.'.join(labels[-length:])
+            if (cut, QUERY_TYPES['NS']) in self.records:
+                return cut
+        return None
+
+    # Answer a question: (RCODE, authoritative, answers, authority, additional)
+    def answer(self, name, q_type):
+        cut = self.delegation(name)
+        if cut is not None:  # referral, with glue for the nameservers inside this zone
+            authority = self.rrset(cut, QUERY_TYPES['NS'])
+            additional = []
+            for _, rdata in self.records[(cut, QUERY_TYPES['NS'])]:
+                ns_name = read_wire_name(rdata)
+                if in_zone(ns_name, self.origin):
+                    additional += self.rrset(ns_name, QUERY_TYPES['A'])
+            return NOERROR, False, [], authority, additional
+
+        owner = name
+        if name not in self.names:  # wildcard at the closest existing name above
+            encloser = name.partition('.')[2]
+            while encloser not in self.names:
+                encloser = encloser.partition('.')[2]
+            name = f"*.{encloser}" if encloser else '*'
+            if name not in self.names:
+                return NXDOMAIN, True, [], self.soa(), []
+
+        answers = self.rrset(name, q_type, owner)
+        if not answers and q_type != QUERY_TYPES['CNAME']:
+            answers = self.rrset(name, QUERY_TYPES['CNAME'], owner)
+        if not answers:
+            return NOERROR, True, [], self.soa(), []  # NODATA
+        return NOERROR, True, answers, [], []
+
+
+# Name in wire format at the start of rdata (names written by encode_name are never compressed)
+def read_wire_name(rdata):
+    labels = []
+    index = 0
+    while rdata[index]:
+        labels.append(rdata[index+1:index+1+rdata[index]].decode())
+        index += 1 + rdata[index]
+    return '.'.join(labels)
+
+
+# Zones of a zone file: lines of "name [ttl] type data..." with absolute names, ';' starting a comment
+# Every SOA record starts a zone at its owner; records before any SOA belong to a zone at the first name, which is
+# given a placeholder SOA
+def read_zones(text):
+    zones = {}
+    records = []
+    for line in text.splitlines():
+        fields = line.split(';')[0].split()
+        if not fields:
+            continue
+        name = normal_name(fields[0])
+        ttl = 300
+        if fields[1].isdigit():
+            ttl = int(fields.pop(1))
+        record_type = QUERY_TYPES[fields[1].upper()]
+        records.append((name, record_type, ttl, encode_rdata(record_type, fields[2:])))
+        if record_type == QUERY_TYPES['SOA']:
+            zones[name] = Zone(name)
+
+    if records and not zones:
+        origin = records[0][0]
+        zones[origin] = Zone(origin)
+        soa = encode_rdata(QUERY_TYPES['SOA'], [f"ns.{origin}", f"admin.{origin}", 1, 3600, 600, 86400, 300])
+        records.insert(0, (origin, QUERY_TYPES['SOA'], 3600, soa))
+
+    for name, record_type, ttl, rdata in records:
+        zone = closest_zone(zones, name)
+        if zone is None:
+            raise ValueError(f"{name} is outside every zone of the file")
+        zone.add(name, record_type, ttl, rdata)
+    return zones
+
+
+# Deepest zone of zones that name is in, or None
+def closest_zone(zones, name):
+    while True:
+        if name in zones:
+            return zones[name]
+        if not name:
+            return None
+        name = name.partition('.')[2]
+
+
+# Authoritative server for zones, answering queries with the configured delay, loss and truncation
+class MockServer:
+
+    def __init__(self, zones, delay=0.0, jitter=0.0, loss=0.0, truncate=0.0, payload_size=1232, edns=True,
+                 seed=None):
+        self.zones = zones
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.truncate = truncate
+        self.payload_size = payload_size
+        self.edns = edns
+        self.random = random.Random(seed)
+        self.counts = collections.Counter()  # queries received, dropped, truncated, over TCP
+
+    # Response to query, or None to drop it (a lost UDP query, or a packet too broken to answer)
+    def respond(self, query, tcp=False):
+        self.counts['tcp queries' if tcp else 'udp queries'] += 1
+        if not tcp and self.random.random() < self.loss:
+            self.counts['dropped'] += 1
+            return None
+
+        try:
+            message = parse_message(query)
+        except MalformedResponse:
+            return None if len(query) < 12 else self.build(query[:2], query[2:4], FORMERR, b'')
+
+        flags = message.flags.to_bytes(2, 'big')
+        if message.flags & 0x8000:
+            return None  # a response, not a query
+        if len(message.questions) != 1:
+            return self.build(query[:2], flags, FORMERR, b'')
+
+        question = message.questions[0]
+        name = normal_name(question.name)
+        try:
+            question_bytes = encode_name(name) + struct.pack('>HH', question.type, question.cls)
+        except DNSError:  # a label that can't be sent back as it was read
+            return self.build(query[:2], flags, FORMERR, b'')
+        opt = self.opt() if message.opt is not None else b''
+
+        if message.opt is not None and not self.edns:
+            return self.build(query[:2], flags, FORMERR, question_bytes)
+        if (message.flags >> 11) & 0x0F:  # only standard queries (OPCODE 0)
+            return self.build(query[:2], flags, NOTIMP, question_bytes, opt=opt)
+
+        zone = closest_zone(self.zones, name)
+        if zone is None:
+            return self.build(query[:2], flags, REFUSED, question_bytes, opt=opt)
+
+        rcode, aa, answers, authority, additional = zone.answer(name, question.type)
+        response = self.build(query[:2], flags, rcode, question_bytes, aa, answers, authority, additional, opt)
+
+        # Over UDP, a response too large for the client (or picked at random) is replaced by an empty truncated one
+        if not tcp and (len(response) > message.payload_size or self.random.random() < self.truncate):
+            self.counts['truncated'] += 1
+            response = self.build(query[:2], flags, rcode, question_bytes, aa, opt=opt, truncated=True)
+        return response
+
+    # Response message with the ID and RD bit of the query
+    @staticmethod
+    def build(request_id, query_flags, rcode, question, aa=False, answers=(), authority=(), additional=(), opt=b'',
+              truncated=False):
+        flags = 0x8000 | (query_flags[0] & 0x01) << 8 | rcode  # QR, RD copied from the query
+        if aa:
+            flags |= 0x0400
+        if truncated:
+            flags |= 0x0200
+        header = request_id + struct.pack('>HHHHH', flags, 1 if question else 0, len(answers), len(authority),
+                                          len(additional) + (1 if opt else 0))
+        return header + question + b''.join(answers) + b''.join(authority) + b''.join(additional) + opt
+
+    # EDNS0 OPT record advertising the server's UDP payload size
+    def opt(self):
+        return b'\x00' + OPT_TYPE.to_bytes(2, 'big') + self.payload_size.to_bytes(2, 'big') + bytes(6)
+
+    # Seconds to wait before answering
+    def wait(self):
+        return self.delay + (self.random.random() * self.jitter if self.jitter else 0.0)
+
+    # Answer query after the delay, with send(response)
+    async def answer(self, query, tcp, send):
+        response = self.respond(query, tcp)
+        if response is None:
+            return
+        delay = self.wait()
+        if delay:
+            await asyncio.sleep(delay)
+        send(response)
+
+
+class UDPServer(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.server.answer(data, False, lambda response: self.transport.sendto(response, addr)))
+
+
+# Serve one TCP connection: any number of length-prefixed queries, answered in the order their delays end
+async def serve_tcp(server, reader, writer):
+    def send(response):
+        if not writer.is_closing():
+            writer.write(len(response).to_bytes(2, 'big') + response)
+
+    tasks = set()
+    try:
+        while True:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+            task = asyncio.ensure_future(server.answer(await reader.readexactly(length), True, send))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (asyncio.IncompleteReadError, OSError):
+        pass
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+
+# Listen on address and port (UDP and TCP) until cancelled; ready, if given, is called once both are bound
+async def run_server(server, address, port, ready=None):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: UDPServer(server), local_addr=(address, port))
+    tcp_server = await asyncio.start_server(lambda reader, writer: serve_tcp(server, reader, writer), address, port)
+    try:
+        if ready is not None:
+            ready()
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        tcp_server.close()
+
+
+def main():
+    args = parse_args()
+    validate_args(args)
+
+    zones = {}
+    for path in args.zone:
+        with open(path) as file:
+            zones.update(read_zones(file.read()))
+    if not args.zone:
+        zones = read_zones(DEFAULT_ZONE)
+
+    server = MockServer(zones, args.delay, args.jitter, args.loss, args.truncate, args.payload_size,
+                        not args.no_edns, args.seed)
+
+    # The ready line tells a parent process (such as the benchmark) that queries can be sent
+    def ready():
+        print(f"Mock DNS server listening on {args.address}:{args.port} "
+              f"(zones: {', '.join(zone or '.' for zone in zones)})", flush=True)
+
+    try:
+        asyncio.run(run_server(server, args.address, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+    print(', '.join(f"{count} {name}" for name, count in sorted(server.counts.items())))
+
+
+if __name__ == "__main__":
+    main()